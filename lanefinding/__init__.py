@@ -0,0 +1,6 @@
+"""Advanced lane finding: camera calibration, thresholding, lane search and overlay rendering
+
+Submodules are imported on demand so workers and the command line only load what they use; matplotlib is
+only imported when a manual check is requested. Numba is optional, it compiles the fused threshold kernel.
+Run `python -m lanefinding --help` for the command line.
+"""
@@ -0,0 +1,185 @@
+import argparse
+import csv
+import glob
+import json
+import os
+from multiprocessing import Pool
+
+import numpy as np
+import cv2
+
+from . import batched
+from . import calibration
+from . import pipeline
+from . import remap
+from . import utils
+
+IMAGE_EXTENSIONS = ('*.jpg', '*.jpeg', '*.png')
+FIELDS = ['image', 'output', 'left_fit', 'right_fit', 'off_center_m', 'left_curvature_m', 'right_curvature_m', 'error']
+
+# Per worker process, set up once by initWorker
+_worker = {}
+
+
+def findImages(source):
+    """Returns the sorted image paths of a directory or glob pattern
+    """
+    if os.path.isdir(source):
+        return sorted(f for ext in IMAGE_EXTENSIONS for f in glob.glob(os.path.join(source, ext)))
+    return sorted(glob.glob(source))
+
+
+def initWorker(pattern, output_dir, threads = 1):
+    _worker['cal'] = calibration.getCalibration(pattern)
+    _worker['threads'] = threads
+    # (width, height) -> BatchStages of a pipeline calibrated for stills of that size
+    _worker['stages'] = {}
+    _worker['output_dir'] = output_dir
+
+
+def stagesFor(size):
+    """Returns the BatchStages for stills of size (width, height), built on first use with the calibration scaled to it
+    """
+    stages = _worker['stages'].get(size)
+    if stages is None:
+        cal = _worker['cal']
+        if size != tuple(cal.img_size):
+            cal = calibration.scaleCalibration(cal, size)
+        stages = batched.BatchStages(pipeline.LanePipeline(cal, remap.getRemapTables(cal)), _worker['threads'])
+        _worker['stages'][size] = stages
+    return stages
+
+
+def describe(error):
+    return '%s: %s' % (type(error).__name__, error)
+
+
+def readImage(fpath):
+    img = cv2.imread(fpath)
+    if img is None:
+        raise IOError('cannot read image ' + fpath)
+    return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+
+
+def saveResult(record, result, left_fit, right_fit):
+    # The bird's-eye view has the size of the still, see stagesFor
+    height, width = result.shape[:2]
+    ym_per_pix, xm_per_pix = utils.laneScale((width, height))
+    off_center, left_curv, right_curv = utils.measureLane(left_fit, right_fit, height, ym_per_pix, xm_per_pix, width/2)
+    name = os.path.splitext(os.path.basename(record['image']))[0]
+    record['output'] = os.path.join(_worker['output_dir'], name + '.jpg')
+    cv2.imwrite(record['output'], cv2.cvtColor(result, cv2.COLOR_RGB2BGR))
+    record['left_fit'] = [float(v) for v in left_fit]
+    record['right_fit'] = [float(v) for v in right_fit]
+    record['off_center_m'] = float(off_center)
+    record['left_curvature_m'] = float(left_curv)
+    record['right_curvature_m'] = float(right_curv)
+
+
+def processChunk(fpaths):
+    """Runs the full pipeline on a chunk of stills and writes their overlays and JSON records, returns the records
+
+    Equally sized stills go through CLAHE, warp, threshold and rendering as one batch, see batched.BatchStages,
+    with the calibration scaled to their size.
+    A failure is recorded on the stills it affects, one bad frame must not abort a regression run of thousands.
+    """
+    records = [dict(dict.fromkeys(FIELDS), image = fpath) for fpath in fpaths]
+    images = {}
+    for i, fpath in enumerate(fpaths):
+        try:
+            images[i] = readImage(fpath)
+        except Exception as e:
+            records[i]['error'] = describe(e)
+
+    groups = {}
+    for i, img in images.items():
+        groups.setdefault(img.shape, []).append(i)
+    for shape, indices in groups.items():
+        try:
+            stages = stagesFor((shape[1], shape[0]))
+            lanePipeline = stages.lanePipeline
+            batch = np.stack([images[i] for i in indices])
+            pixels = stages.pixels(stages.equalizeWarp(batch))
+        except Exception as e:
+            for i in indices:
+                records[i]['error'] = describe(e)
+            continue
+        fits = {}
+        for i, index in zip(indices, pixels):
+            try:
+                # Stills have no previous frame, always run the sliding window search
+                lanePipeline.reset()
+                fits[i] = lanePipeline.track(None, index = index, frame = images[i])
+            except Exception as e:
+                records[i]['error'] = describe(e)
+        found = [i for i in indices if i in fits]
+        if not found:
+            continue
+        try:
+            results = stages.render(batch[[indices.index(i) for i in found]], [fits[i] for i in found])
+            for i, result in zip(found, results):
+                saveResult(records[i], result, *fits[i])
+        except Exception as e:
+            for i in found:
+                records[i]['error'] = describe(e)
+
+    for record in records:
+        name = os.path.splitext(os.path.basename(record['image']))[0]
+        with open(os.path.join(_worker['output_dir'], name + '.json'), 'w') as f:
+            json.dump(record, f, indent = 2)
+    return records
+
+
+def processImage(fpath):
+    """Runs the full pipeline on one still and writes its overlay and JSON record, returns the record
+    """
+    return processChunk([fpath])[0]
+
+
+def processImages(fpaths, output_dir = 'output_images', pattern = calibration.CALIBRATION_GLOB, processes = None,
+                  chunksize = 8, threads = 1):
+    """Shards fpaths across a process pool, returns the records in input order and writes lanes.csv
+
+    Each worker processes chunks of chunksize stills, splitting every batched stage across threads.
+    """
+    os.makedirs(output_dir, exist_ok = True)
+    # Calibrate once up front so workers only ever load the cached artifact
+    cal = calibration.getCalibration(pattern)
+    remap.getRemapTables(cal)
+
+    chunks = [fpaths[start:start + chunksize] for start in range(0, len(fpaths), chunksize)]
+    with Pool(processes, initializer = initWorker, initargs = (pattern, output_dir, threads)) as pool:
+        records = [record for chunk in pool.map(processChunk, chunks, chunksize = 1) for record in chunk]
+
+    with open(os.path.join(output_dir, 'lanes.csv'), 'w', newline = '') as f:
+        writer = csv.DictWriter(f, fieldnames = FIELDS)
+        writer.writeheader()
+        for record in records:
+            row = dict(record)
+            for key in ('left_fit', 'right_fit'):
+                if row[key] is not None:
+                    row[key] = ' '.join(repr(v) for v in row[key])
+            writer.writerow(row)
+    return records
+
+
+def main(argv = None, prog = None):
+    parser = argparse.ArgumentParser(prog = prog, description = 'Detect lanes on a directory or glob of still images')
+    parser.add_argument('source', help = 'image directory or glob pattern, e.g. "test_images/*.jpg"')
+    parser.add_argument('--output', default = 'output_images', help = 'directory for overlays and fit records')
+    parser.add_argument('--calibration', default = calibration.CALIBRATION_GLOB, help = 'chessboard image glob')
+    parser.add_argument('--processes', type = int, default = None, help = 'worker processes, default cpu count')
+    parser.add_argument('--chunk', type = int, default = 8, help = 'stills batched together per worker job')
+    parser.add_argument('--threads', type = int, default = 1, help = 'threads per worker for the batched stages')
+    args = parser.parse_args(argv)
+
+    records = processImages(findImages(args.source), args.output, args.calibration, args.processes, args.chunk,
+                            args.threads)
+    failed = [r for r in records if r['error'] is not None]
+    print('%d images, %d failed' % (len(records), len(failed)))
+    for record in failed:
+        print(record['image'], record['error'])
+
+
+if __name__ == '__main__':
+    main()
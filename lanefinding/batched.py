@@ -0,0 +1,166 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from . import bitmask
+from . import remap
+
+
+def frameShape(frames):
+    """Returns the common shape of a list of frames or of the rows of an (N, H, W, ...) array
+    """
+    if isinstance(frames, np.ndarray):
+        return frames.shape[1:]
+    if len(frames) == 0:
+        raise ValueError('empty batch')
+    shape = frames[0].shape
+    for i, frame in enumerate(frames):
+        if frame.shape != shape:
+            raise ValueError('frame %d is %s, expected %s' % (i, frame.shape, shape))
+    return shape
+
+
+def output(out, shape, dtype):
+    if out is None:
+        return np.empty(shape, dtype)
+    if out.shape != shape or out.dtype != dtype:
+        raise ValueError('out is %s %s, expected %s %s' % (out.shape, out.dtype, shape, np.dtype(dtype)))
+    return out
+
+
+class BatchStages:
+    """The stateless per-frame stages of a LanePipeline over whole batches of frames
+
+    Every stage takes an (N, H, W, 3) array or a list of equally sized frames and returns one (N, ...) array,
+    written to out when given, e.g. a memory map. The batch is split into one contiguous chunk per worker
+    thread; OpenCV and the fused kernel release the GIL, so the chunks run in parallel. Each thread owns a
+    clone of the pipeline for its CLAHE object and scratch buffers.
+    """
+    def __init__(self, lanePipeline, workers = None):
+        self.lanePipeline = lanePipeline
+        self.workers = workers if workers is not None else os.cpu_count() or 1
+        self.local = threading.local()
+        self.executor = ThreadPoolExecutor(self.workers)
+
+    def pipeline(self):
+        p = getattr(self.local, 'pipeline', None)
+        if p is None:
+            p = self.local.pipeline = self.lanePipeline.clone()
+        return p
+
+    def run(self, fn, count):
+        # fn(pipeline, i) for i in range(count), one chunk of consecutive frames per thread
+        def chunk(start, stop):
+            p = self.pipeline()
+            for i in range(start, stop):
+                fn(p, i)
+
+        bounds = np.linspace(0, count, min(self.workers, count) + 1).astype(int)
+        futures = [self.executor.submit(chunk, start, stop) for start, stop in zip(bounds[:-1], bounds[1:])]
+        for future in futures:
+            future.result()
+
+    def undistort(self, frames, out = None):
+        """Returns the undistorted raw frames
+        """
+        out = output(out, (len(frames),) + frameShape(frames), np.uint8)
+        self.run(lambda p, i: remap.undistortFrame(frames[i], p.tables, dst = out[i]), len(frames))
+        return out
+
+    def warp(self, frames, out = None):
+        """Returns the raw frames warped onto the processing grid
+        """
+        width, height = self.lanePipeline.roi_tables.warped_size
+        out = output(out, (len(frames), height, width) + frameShape(frames)[2:], np.uint8)
+        self.run(lambda p, i: remap.warpFrame(frames[i], p.roi_tables, dst = out[i]), len(frames))
+        return out
+
+    def equalizeWarp(self, frames, out = None):
+        """Returns the raw frames CLAHE equalized and warped onto the processing grid, see LanePipeline.equalizeWarp
+        """
+        width, height = self.lanePipeline.roi_tables.warped_size
+        out = output(out, (len(frames), height, width) + frameShape(frames)[2:], np.uint8)
+        self.run(lambda p, i: remap.warpFrame(p.equalize(frames[i]), p.roi_tables, dst = out[i]), len(frames))
+        return out
+
+    def threshold(self, equalized, out = None):
+        """Returns the threshold binaries of equalized and warped frames as (N, H, ceil(W/8)) packed rows
+
+        out[i] are the bits of a bitmask.PackedMask of width W.
+        """
+        height, width = frameShape(equalized)[:2]
+        out = output(out, (len(equalized), height, (width + 7) // 8), np.uint8)
+        self.run(lambda p, i: np.copyto(out[i], p.engine.applyPacked(equalized[i])[0].bits), len(equalized))
+        return out
+
+    def pixels(self, equalized):
+        """Returns the pixelindex.RowPixelIndex of every equalized and warped frame, see fused.FusedThreshold
+        """
+        indexes = [None]*len(equalized)
+
+        def find(p, i):
+            indexes[i] = p.fusedThreshold()(equalized[i])
+        self.run(find, len(equalized))
+        return indexes
+
+    def histograms(self, packed, width):
+        """Returns the (N, W) column sums of the bottom quarter of every packed binary, where the lane search starts
+        """
+        height = packed.shape[1]
+        # One reduction over the whole batch, no per-frame calls to amortize
+        return bitmask.columnHistogram(packed, width, int(3*height/4), height)
+
+    def render(self, frames, fits, out = None):
+        """Returns the frames with the lane of their (left_fit, right_fit) drawn on them
+
+        fits is a sequence of (left_fit, right_fit) or an (N, 2, 3) array; out may be frames to draw in place.
+        """
+        out = output(out, (len(frames),) + frameShape(frames), np.uint8)
+        self.run(lambda p, i: p.render(frames[i], fits[i][0], fits[i][1], out = out[i]), len(frames))
+        return out
+
+    def process(self, frames, out = None):
+        """Returns lanePipeline.process of every frame, in order, as one (N, H, W, 3) array
+
+        Thresholding and rendering run across the threads, the lane tracking of lanePipeline runs serially in
+        frame order in between. With a tracker the frames to detect are scheduled up front, so skipping
+        follows the confidence of the previous batch; skipped frames are still detected, serially, once the
+        confidence collapses or too many in a row were skipped.
+        """
+        lanePipeline = self.lanePipeline
+        count = len(frames)
+        sinks = [lanePipeline.nextFrame() for _ in range(count)]
+        detect = [lanePipeline.scheduleDetection() for _ in range(count)]
+        indexes = [None]*count
+
+        def find(p, i):
+            if detect[i]:
+                indexes[i] = p.pixels(frames[i], sinks[i])
+        self.run(find, count)
+
+        fits = np.empty((count, 2, 3))
+        for i in range(count):
+            if detect[i]:
+                fits[i] = lanePipeline.track(None, sinks[i], indexes[i], frames[i])
+            elif lanePipeline.detectionDue():
+                fits[i] = lanePipeline.track(None, sinks[i], lanePipeline.pixels(frames[i], sinks[i]), frames[i])
+            else:
+                fits[i] = lanePipeline.coast(sinks[i])
+
+        out = output(out, (count,) + frameShape(frames), np.uint8)
+
+        def render(p, i):
+            p.render(frames[i], fits[i][0], fits[i][1], out = out[i], sink = sinks[i])
+        self.run(render, count)
+        return out
+
+    def shutdown(self):
+        self.executor.shutdown(wait = True, cancel_futures = True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
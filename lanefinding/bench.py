@@ -0,0 +1,255 @@
+import argparse
+import glob
+import json
+import platform
+import resource
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import cv2
+
+from . import batched
+from . import calibration
+from . import fused
+from . import metrics
+from . import pipeline
+from . import remap
+from . import utils
+from . import video
+
+RESOLUTIONS = {'720p': (1280, 720), '1080p': (1920, 1080), '4k': (3840, 2160)}
+# Result fields compared against a baseline, a drop by more than the threshold is a regression
+COMPARED_FIELDS = ('fps',)
+# Frames per BatchStages.process call of the batched video run
+BATCH_SIZE = 16
+# Frames of the untimed memory pass of each video run
+TRACED_FRAMES = 8
+
+
+def syntheticFrames(cal, count, seed = 0):
+    """Yields count deterministic RGB road frames of size cal.img_size with two slowly curving lanes
+
+    The lanes are drawn in the bird's-eye view of cal and warped into the camera view with cal.inverseM.
+    """
+    width, height = cal.img_size
+    scale = width / 1280
+    rng = np.random.default_rng(seed)
+    texture = rng.integers(70, 110, (height, width), dtype=np.uint8)
+    asphalt = np.dstack((texture, texture, texture + 5))
+    sky = np.zeros((height, width, 3), np.uint8)
+    sky[:] = (70, 90, 120)
+    ploty = np.arange(0, height, 4, dtype=np.float64)
+    for i in range(count):
+        # Curvature sweeps left and right over the clip, the car drifts a little
+        bend = 2.5e-4 / scale * np.sin(i / 40.0)
+        drift = 15 * scale * np.sin(i / 23.0)
+        canvas = asphalt.copy()
+        for base, color, dashed in ((390, (230, 200, 40), False), (890, (240, 240, 240), True)):
+            fitx = base*scale + drift + bend*(height - ploty)**2
+            pts = np.int32(np.transpose(np.vstack([fitx, ploty])))
+            if dashed:
+                # 15 of every 30 points are painted, the dashes move 3 points per frame
+                offset = i*3 % 30
+                for start in range(offset - 30, len(pts), 30):
+                    dash = pts[max(start, 0):start+15]
+                    if len(dash) > 1:
+                        cv2.polylines(canvas, [dash], False, color, int(14*scale))
+            else:
+                cv2.polylines(canvas, [pts], False, color, int(14*scale))
+        frame = cv2.warpPerspective(canvas, cal.inverseM, (width, height), flags=cv2.INTER_LINEAR,
+                                    borderMode=cv2.BORDER_CONSTANT, borderValue=(0, 0, 0))
+        mask = cv2.warpPerspective(np.full((height, width), 255, np.uint8), cal.inverseM, (width, height))
+        frame[mask == 0] = sky[mask == 0]
+        yield frame
+
+
+def measure(fn, repeat = 5, warmup = 1, traced = None):
+    """Returns the latency (ms) statistics and throughput of calling fn repeatedly, and its peak traced memory
+
+    The allocation hooks of tracemalloc slow Python heavy code down several times, so the memory is taken
+    in one more untimed call, of traced when given, otherwise of fn.
+    """
+    for _ in range(warmup):
+        fn()
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        (traced or fn)()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    samples = np.array(samples)*1000
+    return {'mean_ms': float(samples.mean()), 'p50_ms': float(np.percentile(samples, 50)),
+            'p95_ms': float(np.percentile(samples, 95)), 'fps': float(1000 / samples.mean()),
+            'peak_traced_bytes': int(peak)}
+
+
+def readImages(pattern = 'test_images/*.jpg'):
+    return [cv2.cvtColor(cv2.imread(f), cv2.COLOR_BGR2RGB) for f in sorted(glob.glob(pattern))]
+
+
+def benchFunctions(cal, tables, images, repeat):
+    """Benchmarks each public utils function over all images, one result per function
+    """
+    engine_pipeline = pipeline.LanePipeline(cal, tables)
+    undistorted = [cv2.undistort(img, cal.mtx, cal.dist) for img in images]
+    # Equalized on the camera frame then warped, what the threshold stage sees
+    warped = [remap.warpFrame(utils.getCLAHE(img), tables) for img in images]
+    binaries = [utils.getWarpedBinary(img, tables) for img in images]
+    fits = [utils.detectLanesWithoutPreFrame(b, 50, 8) for b in binaries]
+
+    def each(fn, items):
+        return lambda: [fn(item) for item in items]
+
+    cases = {
+        'cv2.undistort': each(lambda img: cv2.undistort(img, cal.mtx, cal.dist), images),
+        'remap.warpFrame': each(lambda img: remap.warpFrame(img, tables), images),
+        'utils.getCLAHE': each(utils.getCLAHE, images),
+        'utils.createThresholdBinary': each(utils.createThresholdBinary, warped),
+        'threshold.ThresholdEngine.apply': each(utils.thresholdEngine.apply, warped),
+        'fused.FusedThreshold': each(fused.FusedThreshold(utils.thresholdEngine), warped),
+        'utils.getPerspectiveBinary': each(lambda img: utils.getPerspectiveBinary(img, cal.M), undistorted),
+        'utils.getWarpedBinary': each(lambda img: utils.getWarpedBinary(img, tables), images),
+        'utils.detectLanesWithoutPreFrame': each(lambda b: utils.detectLanesWithoutPreFrame(b, 50, 8), binaries),
+        'utils.detectLanesWithPreFram': lambda: [utils.detectLanesWithPreFram(b, 20, l, r) for b, (l, r) in zip(binaries, fits)],
+        'utils.find_window_centroids': each(lambda b: utils.find_window_centroids(b, 50, 80, 100), binaries),
+        'utils.drawDetectedBoundary': lambda: [utils.drawDetectedBoundary(img, cal.inverseM, l, r)
+                                               for img, (l, r) in zip(undistorted, fits)],
+        'utils.measureLane': lambda: [utils.measureLane(l, r) for l, r in fits],
+        'LanePipeline.process': lambda: [engine_pipeline.process(img) for img in images],
+    }
+    results = {}
+    for name, fn in cases.items():
+        result = measure(fn, repeat)
+        # Per image numbers, the cases loop over all images
+        result['mean_ms'] /= len(images)
+        result['p50_ms'] /= len(images)
+        result['p95_ms'] /= len(images)
+        result['fps'] *= len(images)
+        results[name] = result
+    return results
+
+
+def benchVideo(cal, name, size, frames, workers):
+    """Runs the synthetic clip at one resolution serially, streamed, batched, on a lane ROI and tracked, with per-stage latencies
+    """
+    scaled = calibration.scaleCalibration(cal, size)
+    tables = remap.getRemapTables(scaled)
+    clip = list(syntheticFrames(scaled, frames))
+
+    def run(lanePipeline, process, stage_metrics = None):
+        # One warmup frame builds the tables, loads the compiled kernels and starts the threads, then the
+        # tracking starts over; stage_metrics only sees the timed frames
+        process(clip[:1])
+        lanePipeline.reset()
+        if stage_metrics is not None:
+            lanePipeline.metrics = stage_metrics
+
+        def traced():
+            lanePipeline.metrics = metrics.NullMetrics()
+            lanePipeline.reset()
+            process(clip[:TRACED_FRAMES])
+
+        timed = measure(lambda: process(clip), repeat = 1, warmup = 0, traced = traced)
+        timed['fps'] *= len(clip)
+        return timed
+
+    stage_metrics = metrics.Metrics()
+    serial = pipeline.LanePipeline(scaled, tables)
+    result = {'serial': run(serial, lambda frames: [serial.process(f) for f in frames], stage_metrics)}
+    result['stages_ms'] = {stage: {k: (v*1000 if k != 'count' else v) for k, v in s.items()}
+                           for stage, s in stage_metrics.snapshot()['stages'].items()}
+    result['counters'] = stage_metrics.snapshot()['counters']
+
+    streamed = pipeline.LanePipeline(scaled, tables)
+    result['streamed'] = run(streamed, lambda frames: list(video.streamFrames(iter(frames), streamed, workers)))
+
+    # Stateless stages of BATCH_SIZE frames at a time split across the threads
+    batch_pipeline = pipeline.LanePipeline(scaled, tables)
+    with batched.BatchStages(batch_pipeline, workers) as stages:
+        result['batched'] = run(batch_pipeline, lambda frames: [stages.process(frames[i:i + BATCH_SIZE])
+                                                                for i in range(0, len(frames), BATCH_SIZE)])
+
+    # Half resolution processing grid around the lanes
+    roi = pipeline.LanePipeline(scaled, tables, roi = remap.laneRoi(size, scale = 0.5))
+    result['roi'] = run(roi, lambda frames: [roi.process(f) for f in frames])
+
+    # Kalman tracking, detecting every third frame while confident
+    tracked = pipeline.LanePipeline(scaled, tables, track_every = 3)
+    result['tracked'] = run(tracked, lambda frames: [tracked.process(f) for f in frames])
+    return result
+
+
+def runSuite(resolutions = ('720p', '1080p', '4k'), frames = 60, repeat = 5, workers = None):
+    cal = calibration.getCalibration()
+    tables = remap.getRemapTables(cal)
+    results = {
+        'system': {'python': sys.version.split()[0], 'numpy': np.__version__, 'opencv': cv2.__version__,
+                   'numba': fused.numbaVersion(),
+                   'machine': platform.machine(), 'processor': platform.processor()},
+        'functions': benchFunctions(cal, tables, readImages(), repeat),
+        'video': {name: benchVideo(cal, name, RESOLUTIONS[name], frames, workers) for name in resolutions},
+    }
+    # ru_maxrss is in kilobytes on Linux
+    results['system']['peak_rss_bytes'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024
+    return results
+
+
+def flatten(results, prefix = ''):
+    """Returns {dotted.path: value} for every compared field of a results tree
+    """
+    flat = {}
+    for key, value in results.items():
+        path = prefix + key
+        if isinstance(value, dict):
+            flat.update(flatten(value, path + '.'))
+        elif key in COMPARED_FIELDS:
+            flat[path] = value
+    return flat
+
+
+def compare(results, baseline, threshold = 0.1):
+    """Returns (path, baseline fps, current fps) for every result slower than baseline by more than threshold
+    """
+    current = flatten(results)
+    regressions = []
+    for path, old in flatten(baseline).items():
+        new = current.get(path)
+        if new is not None and new < old*(1 - threshold):
+            regressions.append((path, old, new))
+    return regressions
+
+
+def main(argv = None, prog = None):
+    parser = argparse.ArgumentParser(prog = prog, description = 'Benchmark utils and the lane pipeline')
+    parser.add_argument('--output', default = 'bench_results.json', help = 'where to save the results')
+    parser.add_argument('--baseline', help = 'results file to compare against')
+    parser.add_argument('--threshold', type = float, default = 0.1, help = 'allowed relative fps drop, default 0.1')
+    parser.add_argument('--resolutions', default = '720p,1080p,4k', help = 'comma separated, of ' + ','.join(RESOLUTIONS))
+    parser.add_argument('--frames', type = int, default = 60, help = 'synthetic frames per resolution')
+    parser.add_argument('--repeat', type = int, default = 5, help = 'repetitions per function benchmark')
+    parser.add_argument('--workers', type = int, default = None, help = 'threads for the streamed video run')
+    args = parser.parse_args(argv)
+
+    results = runSuite(args.resolutions.split(','), args.frames, args.repeat, args.workers)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent = 2, sort_keys = True)
+    for path, value in sorted(flatten(results).items()):
+        print('%-60s %10.1f fps' % (path, value))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for path, old, new in regressions:
+            print('REGRESSION %s: %.1f -> %.1f fps' % (path, old, new))
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
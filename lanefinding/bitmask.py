@@ -0,0 +1,86 @@
+import numpy as np
+
+# Row j of a byte's bits, most significant first like np.packbits: column j is x offset j within the byte
+_BITS = np.unpackbits(np.arange(256, dtype=np.uint8)[:, np.newaxis], axis=1).astype(bool)
+_POPCOUNT = _BITS.sum(axis=1).astype(np.uint8)
+
+
+def pack(binary):
+    """Returns the rows of a (..., H, W) binary bit-packed along x, shape (..., H, ceil(W/8))
+    """
+    return np.packbits(binary, axis=-1)
+
+
+def columnHistogram(bits, width, y_low, y_high):
+    """Returns the lit pixels per column of rows y_low <= y < y_high of (..., H, ceil(W/8)) packed rows
+
+    Only the rows of the band are unpacked, a batch of masks is reduced in one call.
+    """
+    band = np.unpackbits(bits[..., y_low:y_high, :], axis=-1, count=width)
+    # 0/1 rows summed in uint16 cannot overflow below 65536 rows
+    return band.sum(axis=-2, dtype=np.uint16 if band.shape[-2] < 1 << 16 else np.int64)
+
+
+class PackedMask:
+    """A 0/1 binary image stored as bit-packed rows, 8x smaller than the uint8 binary
+
+    The layout is np.packbits(binary, axis=-1), so packed arrays from memory maps or other processes wrap
+    without a copy. Padding bits past width are zero. Supports or, per row band popcount and column
+    histograms without unpacking the whole image, and the row-major nonzero() of pixelindex.RowPixelIndex.
+    """
+    def __init__(self, bits, width):
+        self.bits = bits
+        self.width = width
+
+    @classmethod
+    def fromBinary(cls, binary):
+        return cls(pack(binary), binary.shape[-1])
+
+    @classmethod
+    def fromPixels(cls, y, x, shape):
+        """Returns the mask of shape (H, W) with the pixels (y, x) lit, e.g. of a pixelindex.RowPixelIndex
+        """
+        height, width = shape
+        bits = np.zeros((height, (width + 7) // 8), np.uint8)
+        position = np.asarray(y, np.intp)*(bits.shape[1]*8) + x
+        np.bitwise_or.at(bits.reshape(-1), position >> 3, (128 >> (position & 7)).astype(np.uint8))
+        return cls(bits, width)
+
+    @property
+    def shape(self):
+        return (self.bits.shape[0], self.width)
+
+    @property
+    def nbytes(self):
+        return self.bits.nbytes
+
+    def toBinary(self):
+        return np.unpackbits(self.bits, axis=-1, count=self.width)
+
+    def __or__(self, other):
+        return PackedMask(np.bitwise_or(self.bits, other.bits), self.width)
+
+    def __ior__(self, other):
+        np.bitwise_or(self.bits, other.bits, out=self.bits)
+        return self
+
+    def count(self, y_low = 0, y_high = None):
+        """Returns the number of lit pixels within y_low <= y < y_high
+        """
+        return int(_POPCOUNT[self.bits[y_low:y_high]].sum(dtype=np.int64))
+
+    def columnHistogram(self, y_low, y_high):
+        return columnHistogram(self.bits, self.width, y_low, y_high)
+
+    def nonzero(self):
+        """Returns (y, x) of the lit pixels in row-major order, like binary.nonzero()
+
+        Only the non-zero bytes are expanded, the work grows with the lit pixels and not the image.
+        """
+        flat = np.flatnonzero(self.bits)
+        # k indexes the bits of the non-zero bytes, k >> 3 the byte and k & 7 the bit within it
+        k = np.flatnonzero(_BITS[self.bits.ravel()[flat]])
+        position = flat[k >> 3]*8 + (k & 7)
+        stride = self.bits.shape[-1]*8
+        y = position // stride
+        return y, position - y*stride
@@ -0,0 +1,127 @@
+import glob
+import hashlib
+import os
+from collections import Counter, namedtuple
+from multiprocessing import Pool
+
+import numpy as np
+import cv2
+
+### Manually measured 4 points (255, 683), (1052, 683), (594, 448), (684, 448)
+SRC_POINTS = np.float32([[260.041, 681.833],[1044.35, 681.833], [685.594, 450.61],[593.598, 450.61]])
+# Desired 4 points, make sure the center is 640
+DST_POINTS = np.float32([[390, 700],[890, 700],[890, 0], [390, 0]])
+
+CALIBRATION_GLOB = os.path.join('camera_cal', '*.jpg')
+CACHE_DIR = '.calibration_cache'
+# Bump when the layout of the saved artifact changes so stale caches are ignored
+CACHE_VERSION = 1
+
+Calibration = namedtuple('Calibration', ['mtx', 'dist', 'M', 'inverseM', 'img_size', 'key'])
+
+
+def findChessboardPoints(args):
+    """Returns (corners, (width, height)) of one calibration image, corners is None if not found
+    """
+    fpath, nx, ny = args
+    img = cv2.imread(fpath)
+    if img is None:
+        return None, None
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    ret, corners = cv2.findChessboardCorners(gray, (nx, ny), None)
+    if not ret:
+        return None, gray.shape[::-1]
+    return corners, gray.shape[::-1]
+
+
+def calibrateCameraFromImages(fpaths, nx, ny, processes = None):
+    # Chessboard detection dominates, so run it over all images in a process pool
+    with Pool(processes) as pool:
+        results = pool.map(findChessboardPoints, [(fpath, nx, ny) for fpath in fpaths])
+
+    # Prepare object points, like (0, 0, 0), (1, 0, 0), (2, 0, 0), ..., (8, 5, 0)
+    objp = np.zeros((ny*nx, 3), np.float32)
+    objp[:,:2] = np.mgrid[0:nx, 0:ny].T.reshape(-1, 2)
+
+    objpoints = [] # 3D points in read word space
+    imgpoints = [] # 2D points in image plane
+    sizes = Counter()
+    for corners, size in results:
+        if corners is None:
+            continue
+        imgpoints.append(corners)
+        objpoints.append(objp)
+        sizes[size] += 1
+    if len(imgpoints) == 0:
+        raise ValueError('no %dx%d chessboard found in %d calibration images' % (nx, ny, len(fpaths)))
+
+    # A few images are off by a pixel, calibrate against the most common size
+    img_size = sizes.most_common(1)[0][0]
+    ret, mtx, dist, rvecs, tvecs = cv2.calibrateCamera(objpoints, imgpoints, img_size, None, None)
+    return mtx, dist, img_size
+
+
+def calibrationKey(fpaths, nx, ny, src = SRC_POINTS, dst = DST_POINTS):
+    """Returns a content hash of everything the calibration depends on
+    """
+    h = hashlib.sha1()
+    h.update(('v%d %d %d' % (CACHE_VERSION, nx, ny)).encode())
+    h.update(np.ascontiguousarray(src, np.float32).tobytes())
+    h.update(np.ascontiguousarray(dst, np.float32).tobytes())
+    for fpath in fpaths:
+        h.update(os.path.basename(fpath).encode())
+        with open(fpath, 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+def saveCalibration(path, calibration):
+    # Write to a temporary file first so a crashed worker never leaves a torn artifact
+    tmp_path = path + '.%d.tmp' % os.getpid()
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, mtx=calibration.mtx, dist=calibration.dist, M=calibration.M,
+                 inverseM=calibration.inverseM, img_size=np.int32(calibration.img_size))
+    os.replace(tmp_path, path)
+
+
+def loadCalibration(path, key):
+    with np.load(path) as data:
+        return Calibration(data['mtx'], data['dist'], data['M'], data['inverseM'],
+                           tuple(int(v) for v in data['img_size']), key)
+
+
+def getCalibration(pattern = CALIBRATION_GLOB, nx = 9, ny = 6, src = SRC_POINTS, dst = DST_POINTS,
+                   cache_dir = CACHE_DIR, processes = None):
+    """Returns the cached Calibration for the images matching pattern, calibrating on a miss
+
+    A miss detects the chessboards in a multiprocessing.Pool; under the spawn start method its workers
+    re-import the calling script, which therefore has to run under an if __name__ == '__main__' guard.
+    """
+    fpaths = sorted(glob.glob(pattern))
+    if len(fpaths) == 0:
+        raise ValueError('no calibration images match ' + pattern)
+    key = calibrationKey(fpaths, nx, ny, src, dst)
+    path = os.path.join(cache_dir, 'calibration-' + key + '.npz')
+    if os.path.exists(path):
+        return loadCalibration(path, key)
+
+    mtx, dist, img_size = calibrateCameraFromImages(fpaths, nx, ny, processes = processes)
+    M = cv2.getPerspectiveTransform(src, dst)
+    inverseM = cv2.getPerspectiveTransform(dst, src)
+    calibration = Calibration(mtx, dist, M, inverseM, img_size, key)
+    os.makedirs(cache_dir, exist_ok = True)
+    saveCalibration(path, calibration)
+    return calibration
+
+
+def scaleCalibration(cal, img_size):
+    """Returns cal for frames resized to img_size (width, height), perspective points scale with the frame
+    """
+    sx = img_size[0] / cal.img_size[0]
+    sy = img_size[1] / cal.img_size[1]
+    S = np.array([[sx, 0, 0], [0, sy, 0], [0, 0, 1]])
+    mtx = S @ cal.mtx
+    M = S @ cal.M @ np.linalg.inv(S)
+    inverseM = S @ cal.inverseM @ np.linalg.inv(S)
+    key = '%s-%dx%d' % (cal.key, img_size[0], img_size[1])
+    return Calibration(mtx, cal.dist, M, inverseM, tuple(img_size), key)
@@ -0,0 +1,106 @@
+import argparse
+import sys
+
+from . import calibration
+
+# Subcommands whose module already owns an argument parser
+DELEGATED = {
+    'image': ('batch', 'detect lanes on a directory or glob of still images'),
+    'bench': ('bench', 'benchmark utils and the lane pipeline'),
+    'sweep': ('sweep', 'rank threshold and lane search settings over a set of frames'),
+    'serve': ('service', 'serve lane detection to many streams, or replay images against a server'),
+    'verify': ('verify', 'check the fast threshold paths against utils.createThresholdBinary'),
+}
+
+
+def calibrate(args):
+    cal = calibration.getCalibration(args.calibration, args.nx, args.ny, cache_dir = args.cache_dir,
+                                     processes = args.processes)
+    from . import remap
+    remap.getRemapTables(cal, cache_dir = args.cache_dir)
+    print('calibration %s for %dx%d frames cached in %s' % (cal.key, cal.img_size[0], cal.img_size[1], args.cache_dir))
+
+
+def video(args):
+    import cv2
+    from . import pipeline, remap
+    from . import video as lanevideo
+
+    cal = calibration.getCalibration(args.calibration)
+    capture = cv2.VideoCapture(args.source)
+    size = (int(capture.get(cv2.CAP_PROP_FRAME_WIDTH)), int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+    capture.release()
+    if size[0] == 0 or size[1] == 0:
+        raise SystemExit('cannot read ' + args.source)
+    if size != tuple(cal.img_size):
+        cal = calibration.scaleCalibration(cal, size)
+
+    options = {}
+    if args.roi_scale is not None:
+        options['roi'] = remap.laneRoi(size, scale = args.roi_scale)
+    if args.track_every is not None:
+        options['track_every'] = args.track_every
+    recorder = None
+    if args.debug:
+        from . import debug
+        recorder = debug.DebugRecorder(args.debug, every = args.debug_every)
+        options['sink'] = recorder
+    if args.metrics:
+        from . import metrics
+        options['metrics'] = metrics.Metrics(args.metrics)
+
+    lanePipeline = pipeline.LanePipeline(cal, remap.getRemapTables(cal), **options)
+    try:
+        count = lanevideo.processVideo(args.source, args.output, lanePipeline, args.workers, args.depth, args.fourcc)
+    finally:
+        if recorder is not None:
+            recorder.close()
+    print('%d frames written to %s' % (count, args.output))
+
+
+def buildParser():
+    parser = argparse.ArgumentParser(prog = 'lanefinding', description = 'Advanced lane finding')
+    commands = parser.add_subparsers(dest = 'command', metavar = 'command')
+
+    sub = commands.add_parser('calibrate', help = 'calibrate the camera and cache the remap tables')
+    sub.add_argument('--calibration', default = calibration.CALIBRATION_GLOB, help = 'chessboard image glob')
+    sub.add_argument('--nx', type = int, default = 9, help = 'inside corners per row')
+    sub.add_argument('--ny', type = int, default = 6, help = 'inside corners per column')
+    sub.add_argument('--cache-dir', default = calibration.CACHE_DIR)
+    sub.add_argument('--processes', type = int, default = None, help = 'worker processes, default cpu count')
+    sub.set_defaults(run = calibrate)
+
+    sub = commands.add_parser('video', help = 'draw the detected lane on every frame of a video')
+    sub.add_argument('source', help = 'input video, e.g. project_video.mp4')
+    sub.add_argument('output', help = 'output video')
+    sub.add_argument('--calibration', default = calibration.CALIBRATION_GLOB, help = 'chessboard image glob')
+    sub.add_argument('--workers', type = int, default = None, help = 'threads for the per-frame stages, default cpu count')
+    sub.add_argument('--depth', type = int, default = None, help = 'frames in flight, default twice the workers')
+    sub.add_argument('--fourcc', default = 'mp4v')
+    sub.add_argument('--roi-scale', type = float, default = None, help = 'process a lane ROI at this scale')
+    sub.add_argument('--track-every', type = int, default = None, help = 'detect every Nth frame while tracking is confident')
+    sub.add_argument('--debug', metavar = 'DIR', help = 'save the intermediate images to DIR')
+    sub.add_argument('--debug-every', type = int, default = 25, help = 'frames between debug snapshots')
+    sub.add_argument('--metrics', metavar = 'PATH', help = 'write stage timings and counters to PATH, .prom for Prometheus')
+    sub.set_defaults(run = video)
+
+    for name, (module, help) in sorted(DELEGATED.items()):
+        # Parsed by the module itself, listed here for --help
+        commands.add_parser(name, help = help, add_help = False)
+    return parser
+
+
+def main(argv = None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv and argv[0] in DELEGATED:
+        import importlib
+        module = importlib.import_module('.' + DELEGATED[argv[0]][0], __package__)
+        return module.main(argv[1:], prog = 'lanefinding ' + argv[0])
+
+    parser = buildParser()
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.print_help()
+        return 2
+    return args.run(args)
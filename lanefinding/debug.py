@@ -0,0 +1,123 @@
+import json
+import os
+import threading
+from queue import Queue, Full
+
+import numpy as np
+import cv2
+
+
+class NullFrame:
+    """Debug handle of a frame that is not recorded, every call is a no-op
+    """
+    active = False
+    index = None
+
+    def image(self, name, img):
+        pass
+
+    def event(self, name, **info):
+        pass
+
+
+NULL_FRAME = NullFrame()
+
+
+class NullSink:
+    """Default sink: nothing is drawn, printed or saved
+    """
+    def frame(self, index):
+        return NULL_FRAME
+
+    def close(self):
+        pass
+
+
+class RecorderFrame:
+    def __init__(self, recorder, index):
+        self.recorder = recorder
+        self.index = index
+        self.active = True
+
+    def image(self, name, img):
+        # Callers reuse their buffers, so the image is copied before it crosses threads
+        self.recorder.submit(('image', self.index, name, np.array(img, copy=True)))
+
+    def event(self, name, **info):
+        self.recorder.submit(('event', self.index, name, info))
+
+
+class DebugRecorder:
+    """Saves the intermediate images of every Nth frame to output_dir from a background thread
+
+    Images are written as <output_dir>/<frame>-<name>.png and events appended to events.jsonl. When the
+    writer falls behind, items are dropped instead of stalling the pipeline; see dropped.
+    """
+    def __init__(self, output_dir, every = 30, queue_size = 64):
+        self.output_dir = output_dir
+        self.every = max(int(every), 1)
+        self.queue = Queue(queue_size)
+        self.dropped = 0
+        os.makedirs(output_dir, exist_ok = True)
+        self.thread = threading.Thread(target = self.write, daemon = True)
+        self.thread.start()
+
+    def frame(self, index):
+        if index % self.every:
+            return NULL_FRAME
+        return RecorderFrame(self, index)
+
+    def submit(self, item):
+        try:
+            self.queue.put_nowait(item)
+        except Full:
+            self.dropped += 1
+
+    def write(self):
+        events = open(os.path.join(self.output_dir, 'events.jsonl'), 'a')
+        try:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    break
+                kind, index, name, payload = item
+                if kind == 'event':
+                    events.write(json.dumps(dict(payload, frame = index, event = name), default = str) + '\n')
+                    events.flush()
+                else:
+                    cv2.imwrite(os.path.join(self.output_dir, '%06d-%s.png' % (index, name)), toBGR(payload))
+        finally:
+            events.close()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+
+def toBGR(img):
+    # 0/1 binaries are stretched to 0/255, RGB images swapped for cv2.imwrite
+    if img.dtype != np.uint8:
+        img = np.clip(img*255 if img.max() <= 1 else img, 0, 255).astype(np.uint8)
+    elif img.max() <= 1:
+        img = img*255
+    if img.ndim == 3:
+        return cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
+    return img
+
+
+def panel(images, cols = 3):
+    """Returns the images tiled cols per row as one RGB image, single channel images become gray
+    """
+    tiles = []
+    for img in images:
+        img = toBGR(img)
+        if img.ndim == 2:
+            img = np.dstack((img, img, img))
+        else:
+            img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+        tiles.append(img)
+    blank = np.zeros_like(tiles[0])
+    while len(tiles) % cols:
+        tiles.append(blank)
+    rows = [np.hstack(tiles[i:i+cols]) for i in range(0, len(tiles), cols)]
+    return np.vstack(rows)
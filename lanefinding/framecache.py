@@ -0,0 +1,176 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from . import batched
+from . import bitmask
+from . import video
+
+CACHE_DIR = '.frame_cache'
+# Bump when the layout of a cached stage changes so stale entries are ignored
+CACHE_VERSION = 3
+# Frames per call of the batched stages while filling a cache entry
+BATCH_SIZE = 32
+
+
+def sourceKey(fpath, chunk = 1 << 20):
+    """Returns the content hash of a source file
+    """
+    h = hashlib.sha1()
+    with open(fpath, 'rb') as f:
+        for block in iter(lambda: f.read(chunk), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def stageKey(*parts):
+    h = hashlib.sha1(('v%d' % CACHE_VERSION).encode())
+    for part in parts:
+        h.update(repr(part).encode())
+    return h.hexdigest()
+
+
+class PackedBinaries:
+    """Read-only sequence of the bitmask.PackedMask binaries of a clip, wrapping rows of a memory map
+    """
+    def __init__(self, packed, width):
+        self.packed = packed
+        self.width = width
+
+    def __len__(self):
+        return len(self.packed)
+
+    def __getitem__(self, i):
+        return bitmask.PackedMask(self.packed[i], self.width)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+class FrameCache:
+    """On-disk cache of the decoded frames of a clip and of its per-stage intermediates
+
+    Every stage is a raw uint8 array memory-mapped read-only, so readers share the OS page cache and no
+    frame is copied until it is used. Entries are keyed by the source content hash, the calibration key and
+    the parameters of every stage up to it, so changing a parameter only recomputes the stages after it:
+
+        frames   decoded RGB frames                      source
+        warped   CLAHE frames on the processing grid     + CLAHE, calibration, remap tables / ROI
+        binary   bit-packed combined_binary               + thresholds
+
+    An entry is <stage>-<key>.bin with its shape in <stage>-<key>.json, the JSON is written last so a
+    missing or torn entry is simply recomputed.
+    """
+    def __init__(self, cache_dir = CACHE_DIR):
+        self.cache_dir = cache_dir
+        self.source_keys = {}
+        os.makedirs(cache_dir, exist_ok = True)
+
+    def sourceKey(self, src_path):
+        # Hashing a long drive takes a while, remember it for unchanged files
+        stat = os.stat(src_path)
+        ident = (os.path.abspath(src_path), stat.st_size, stat.st_mtime_ns)
+        if ident not in self.source_keys:
+            self.source_keys[ident] = sourceKey(src_path)
+        return self.source_keys[ident]
+
+    def path(self, stage, key):
+        return os.path.join(self.cache_dir, '%s-%s' % (stage, key))
+
+    def load(self, stage, key):
+        """Returns the read-only memory map of an entry, None when it is not cached
+        """
+        path = self.path(stage, key)
+        try:
+            with open(path + '.json') as f:
+                meta = json.load(f)
+        except FileNotFoundError:
+            return None
+        if meta['shape'][0] == 0:
+            return np.empty(meta['shape'], np.uint8)
+        return np.memmap(path + '.bin', np.uint8, mode = 'r', shape = tuple(meta['shape']))
+
+    def store(self, stage, key, items):
+        """Writes the equally shaped uint8 arrays of items as one entry and returns its memory map
+        """
+        path = self.path(stage, key)
+        tmp_path = path + '.%d.tmp' % os.getpid()
+        count = 0
+        shape = None
+        with open(tmp_path, 'wb') as f:
+            for item in items:
+                if shape is None:
+                    shape = item.shape
+                elif item.shape != shape:
+                    raise ValueError('%s frame %d is %s, expected %s' % (stage, count, item.shape, shape))
+                f.write(np.ascontiguousarray(item, np.uint8).data)
+                count += 1
+        os.replace(tmp_path, path + '.bin')
+        with open(tmp_path, 'w') as f:
+            json.dump({'shape': [count] + list(shape or ())}, f)
+        os.replace(tmp_path, path + '.json')
+        return self.load(stage, key)
+
+    def cached(self, stage, key, compute):
+        entry = self.load(stage, key)
+        if entry is None:
+            entry = self.store(stage, key, compute())
+        return entry
+
+    def framesKey(self, src_path):
+        return stageKey('frames', self.sourceKey(src_path))
+
+    def warpedKey(self, src_path, lanePipeline):
+        tables = lanePipeline.roi_tables
+        clahe = (lanePipeline.clahe.getClipLimit(), lanePipeline.clahe.getTilesGridSize())
+        return stageKey('warped', self.framesKey(src_path), clahe, lanePipeline.cal.key, lanePipeline.roi, tables.warped_size)
+
+    def binaryKey(self, src_path, lanePipeline):
+        config = lanePipeline.config
+        return stageKey('binary', self.warpedKey(src_path, lanePipeline),
+                        config['v_thresh'], config['b_thresh'], config['hx_thresh'])
+
+    def frames(self, src_path):
+        """Returns the decoded (n, height, width, 3) RGB frames of a video file
+        """
+        return self.cached('frames', self.framesKey(src_path), lambda: video.readVideo(src_path))
+
+    def warped(self, src_path, lanePipeline):
+        """Returns the frames CLAHE equalized and warped onto the processing grid of lanePipeline, see LanePipeline.equalizeWarp
+        """
+        def compute():
+            frames = self.frames(src_path)
+            with batched.BatchStages(lanePipeline) as stages:
+                for start in range(0, len(frames), BATCH_SIZE):
+                    yield from stages.equalizeWarp(frames[start:start + BATCH_SIZE])
+        return self.cached('warped', self.warpedKey(src_path, lanePipeline), compute)
+
+    def binaries(self, src_path, lanePipeline):
+        """Returns the PackedBinaries of lanePipeline.binary() for every frame
+        """
+        def compute():
+            warped = self.warped(src_path, lanePipeline)
+            with batched.BatchStages(lanePipeline) as stages:
+                for start in range(0, len(warped), BATCH_SIZE):
+                    yield from stages.threshold(warped[start:start + BATCH_SIZE])
+        packed = self.cached('binary', self.binaryKey(src_path, lanePipeline), compute)
+        return PackedBinaries(packed, lanePipeline.roi_tables.warped_size[0])
+
+
+def trackCached(src_path, lanePipeline, cache = None):
+    """Yields the (left_fit, right_fit) of every frame of src_path tracked from cached binaries, for tuning the lane search
+
+    Frames, warps and thresholds are computed once per parameter set; the tracking state of lanePipeline is
+    reset first.
+    """
+    if cache is None:
+        cache = FrameCache()
+    lanePipeline.reset()
+    for binary in cache.binaries(src_path, lanePipeline):
+        if lanePipeline.scheduleDetection():
+            yield lanePipeline.track(binary)
+        else:
+            yield lanePipeline.coast()
@@ -0,0 +1,210 @@
+import threading
+
+import numpy as np
+import cv2
+
+from . import pixelindex
+from . import threshold
+
+_color_tables = {}
+# (prepare, emit) once compiled, () without Numba, see kernels()
+_kernels = None
+_kernels_lock = threading.Lock()
+
+
+def colorTable(v_thresh, b_thresh):
+    """Returns the 2**24 bit table of l_binary | b_binary per RGB color, bit r << 16 | g << 8 | b
+
+    Built once per thresholds by running every color through cv2.cvtColor, so the lookup is bit-identical
+    to ThresholdEngine without converting each frame to LUV and LAB. 2 MB, small enough to stay cached.
+    """
+    key = (tuple(v_thresh), tuple(b_thresh))
+    table = _color_tables.get(key)
+    if table is None:
+        l_table = threshold.rangeTable(v_thresh)
+        b_table = threshold.rangeTable(b_thresh)
+        # One 256x256 (g, b) plane per red value keeps the scratch images small
+        gb = np.empty((256, 256, 3), np.uint8)
+        gb[..., 1] = np.arange(256)[:, np.newaxis]
+        gb[..., 2] = np.arange(256)
+        hits = np.empty((256, 256*256), np.uint8)
+        for r in range(256):
+            gb[..., 0] = r
+            l_binary = l_table[cv2.cvtColor(gb, cv2.COLOR_RGB2LUV)[..., 0]]
+            b_binary = b_table[cv2.cvtColor(gb, cv2.COLOR_RGB2LAB)[..., 2]]
+            hits[r] = (l_binary | b_binary).ravel()
+        table = _color_tables[key] = np.packbits(hits.ravel(), bitorder = 'little')
+    return table
+
+
+def saturationTable():
+    """Returns the HLS s-channel per (max, min) of the RGB components, as a 256*256 table at max*256 + min
+    """
+    table = _color_tables.get('saturation')
+    if table is None:
+        extremes = np.empty((256, 256, 3), np.uint8)
+        extremes[..., 0] = np.arange(256)[:, np.newaxis]
+        extremes[..., 1] = np.minimum(np.arange(256)[:, np.newaxis], np.arange(256))
+        extremes[..., 2] = extremes[..., 1]
+        table = _color_tables['saturation'] = cv2.cvtColor(extremes, cv2.COLOR_RGB2HLS)[..., 2].ravel()
+    return table
+
+
+def _prepare(img, table, saturation, hits, s_channel, gradient):
+    # One pass over the RGB frame: color test and HLS s-channel through the tables, then |Sobel x| of the
+    # s-channel, returns its maximum which scales the gradient threshold. The helpers are nested so Numba
+    # compiles them with it, nothing is looked up in the module globals
+    def sobelX(up, row, down, left, right):
+        # |Sobel x| of the middle row between columns left and right
+        return abs(np.int32(up[right]) - np.int32(up[left]) + 2*(np.int32(row[right]) - np.int32(row[left]))
+                   + np.int32(down[right]) - np.int32(down[left]))
+
+    def reflect(i, size):
+        # cv2.BORDER_REFLECT_101
+        if i < 0:
+            return min(1, size - 1)
+        if i >= size:
+            return max(size - 2, 0)
+        return i
+
+    height, width = img.shape[:2]
+    for y in range(height):
+        for x in range(width):
+            r = np.int32(img[y, x, 0])
+            g = np.int32(img[y, x, 1])
+            b = np.int32(img[y, x, 2])
+            key = (r << 16) | (g << 8) | b
+            hits[y, x] = (table[key >> 3] >> (key & 7)) & 1
+            s_channel[y, x] = saturation[max(r, g, b)*256 + min(r, g, b)]
+    abs_max = 0
+    for y in range(height):
+        # cv2.Sobel(s_channel, cv2.CV_16S, 1, 0) with its default BORDER_REFLECT_101
+        up = s_channel[reflect(y - 1, height)]
+        row = s_channel[y]
+        down = s_channel[reflect(y + 1, height)]
+        for x in range(1, width - 1):
+            value = sobelX(up, row, down, x - 1, x + 1)
+            gradient[y, x] = value
+            abs_max = max(abs_max, value)
+        # Only the border columns need reflecting, the loop above stays branch free
+        for x in (0, width - 1):
+            value = sobelX(up, row, down, reflect(x - 1, width), reflect(x + 1, width))
+            gradient[y, x] = value
+            abs_max = max(abs_max, value)
+    return abs_max
+
+
+def _emit(hits, gradient, low, high, hist_low, ys, xs, row_start, histogram):
+    # Row-major lit pixels into (ys, xs) while they fit, returns their total count
+    height, width = hits.shape
+    capacity = len(ys)
+    histogram[:] = 0
+    count = 0
+    for y in range(height):
+        row_start[y] = count
+        for x in range(width):
+            if hits[y, x] == 0 and (gradient[y, x] < low or gradient[y, x] > high):
+                continue
+            if count < capacity:
+                ys[count] = y
+                xs[count] = x
+            count += 1
+            if y >= hist_low:
+                histogram[x] += 1
+    row_start[height] = count
+    return count
+
+
+def kernels():
+    """Returns the compiled (_prepare, _emit), None when Numba is not installed
+
+    Numba is only imported here, on first use, so importing the pipeline and forking workers stays cheap.
+    Without Numba FusedThreshold runs ThresholdEngine and nonzero(), same pixels, more memory traffic.
+    """
+    global _kernels
+    with _kernels_lock:
+        if _kernels is None:
+            try:
+                import numba
+            except ImportError:
+                _kernels = ()
+            else:
+                # nogil lets the video stage threads run the kernel side by side
+                jit = numba.njit(cache = True, nogil = True)
+                _kernels = (jit(_prepare), jit(_emit))
+    return _kernels or None
+
+
+def numbaVersion():
+    """Returns the version of the installed Numba, None without it
+    """
+    if kernels() is None:
+        return None
+    import numba
+    return numba.__version__
+
+
+class FusedThreshold:
+    """Goes from a bird's-eye RGB frame straight to the pixelindex.RowPixelIndex of its threshold binary
+
+    Replaces ThresholdEngine.apply followed by RowPixelIndex.fromBinary: the LUV / LAB range tests are one
+    bit table lookup per pixel and the HLS s-channel another, Sobel and its range test run in the same
+    kernel, and the lit pixels, row offsets and the column histogram of the bottom quarter come out of the
+    same loop. No full-frame binary is built. The pixels are exactly those of ThresholdEngine.
+
+    The kernel needs Numba; without it the engine and nonzero() are used instead, see compiled.
+    """
+    def __init__(self, engine, hist_from = 0.75):
+        self.engine = engine
+        self.hist_from = hist_from
+        self.kernels = kernels()
+        self.compiled = self.kernels is not None
+        self.table = self.saturation = None
+        if self.compiled:
+            self.table = colorTable(engine.v_thresh, engine.b_thresh)
+            self.saturation = saturationTable()
+        self.buffers = {}
+
+    def buffer(self, name, shape, dtype):
+        buf = self.buffers.get(name)
+        if buf is None or buf.shape != shape or buf.dtype != dtype:
+            buf = self.buffers[name] = np.empty(shape, dtype)
+        return buf
+
+    def gradientRange(self, abs_max):
+        # Inclusive |Sobel x| bounds of sxbinary, as ThresholdEngine.sobelRangeBinary tests them
+        hx_thresh = self.engine.hx_thresh
+        if abs_max == 0:
+            return (0, 0) if hx_thresh[0] <= 0 <= hx_thresh[1] else (1, 0)
+        return threshold.sobelRange(abs_max, hx_thresh)
+
+    def __call__(self, img):
+        """Returns the RowPixelIndex of the lit pixels of img, its arrays are not reused by later calls
+        """
+        height, width = img.shape[:2]
+        hist_low = int(height*self.hist_from)
+        if not self.compiled:
+            combined_binary, _ = self.engine.apply(img)
+            return pixelindex.RowPixelIndex.fromBinary(combined_binary)
+
+        hits = self.buffer('hits', (height, width), np.uint8)
+        gradient = self.buffer('gradient', (height, width), np.uint16)
+        prepare, emit = self.kernels
+        abs_max = prepare(np.ascontiguousarray(img), self.table, self.saturation, hits,
+                           self.buffer('s', (height, width), np.uint8), gradient)
+        low, high = self.gradientRange(abs_max)
+
+        row_start = np.empty(height + 1, np.intp)
+        histogram = np.empty(width, np.intp)
+        # Lane candidates are a small fraction of the frame, rerun with room for all of them otherwise
+        ys = self.buffers.get('ys')
+        if ys is None or len(ys) < height*width//16:
+            ys = self.buffer('ys', (height*width//16 + 1,), np.int32)
+        xs = self.buffer('xs', ys.shape, np.int32)
+        count = emit(hits, gradient, low, high, hist_low, ys, xs, row_start, histogram)
+        if count > len(ys):
+            ys = self.buffer('ys', (count,), np.int32)
+            xs = self.buffer('xs', (count,), np.int32)
+            emit(hits, gradient, low, high, hist_low, ys, xs, row_start, histogram)
+        return pixelindex.RowPixelIndex(ys[:count].astype(np.intp), xs[:count].astype(np.intp), (height, width),
+                                        row_start = row_start, histogram = (hist_low, height, histogram))
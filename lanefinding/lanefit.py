@@ -0,0 +1,103 @@
+from collections import deque
+from math import comb
+
+import numpy as np
+
+# y is divided by this before the powers are taken, keeps the 3x3 normal equations well conditioned
+Y_SCALE = 720.0
+# Layout of a power sums vector: sum(w*t**k) for k = 0..4, then sum(w*x*t**k) for k = 0..2, with t = y/Y_SCALE
+SUMS = 8
+
+
+def powerSums(x, y, weights = None, y_scale = Y_SCALE):
+    """Returns the power sums vector of the pixels (x, y), everything a weighted quadratic fit x = f(y) needs
+
+    Power sums of disjoint pixel sets, or of several frames, add up to the power sums of their union.
+    """
+    t = np.asarray(y, np.float64) / y_scale
+    x = np.asarray(x, np.float64)
+    t2 = t*t
+    if weights is None:
+        return np.array([len(t), t.sum(), t2.sum(), t2 @ t, t2 @ t2, x.sum(), x @ t, x @ t2])
+    w = np.asarray(weights, np.float64)
+    wt = w*t
+    wt2 = w*t2
+    return np.array([w.sum(), wt.sum(), wt2.sum(), wt2 @ t, wt2 @ t2, x @ w, x @ wt, x @ wt2])
+
+
+def solve(sums, y_scale = Y_SCALE):
+    """Returns the [a, b, c] (np.polyfit order) quadratic fits of a (..., SUMS) stack of power sums
+
+    All fits are solved in one batched call. Raises TypeError for an empty pixel set, like np.polyfit, and
+    np.linalg.LinAlgError when the pixels span fewer than three rows.
+    """
+    sums = np.asarray(sums, np.float64)
+    if np.any(sums[..., 0] <= 0):
+        raise TypeError('expected non-empty vector for x')
+    # normal[i, j] = sum(t**(4 - i - j)), rhs[i] = sum(x*t**(2 - i))
+    powers = 4 - np.add.outer(np.arange(3), np.arange(3))
+    normal = sums[..., powers]
+    rhs = sums[..., [7, 6, 5]]
+    coef = np.linalg.solve(normal, rhs[..., None])[..., 0]
+    return coef / np.array([y_scale**2, y_scale, 1.0])
+
+
+def scaleSums(sums, scale, x0 = 0.0, y0 = 0.0, weight = 1.0, y_scale = Y_SCALE):
+    """Returns the power sums of the same pixels moved to (scale*(x - x0), scale*(y - y0)) and weighted by weight
+
+    The closed form of powerSums over the moved pixels, e.g. full bird's-eye pixels onto a remap.Roi grid.
+    """
+    sums = np.asarray(sums, np.float64)
+    # t' = a*t + b, so t'**k = sum(comb(k, j) * a**j * b**(k - j) * t**j)
+    a, b = scale, -scale*y0/y_scale
+    binomial = np.array([[comb(k, j)*a**j*b**(k - j) if j <= k else 0.0 for j in range(5)] for k in range(5)])
+    t_sums = sums[..., :5] @ binomial.T
+    xt_sums = scale*(sums[..., 5:] @ binomial[:3, :3].T) - scale*x0*t_sums[..., :3]
+    return weight*np.concatenate((t_sums, xt_sums), axis = -1)
+
+
+def fitPair(left_sums, right_sums):
+    """Returns (left_fit, right_fit) of both lanes from their power sums
+    """
+    left_fit, right_fit = solve(np.stack((left_sums, right_sums)))
+    return left_fit, right_fit
+
+
+def worldFit(fit, ym_per_pix = 30/720, xm_per_pix = 3.7/700):
+    """Returns the pixel fit x = f(y) rescaled to meters, the closed form of resampling and refitting it
+    """
+    a, b, c = fit
+    return np.array([a*xm_per_pix/ym_per_pix**2, b*xm_per_pix/ym_per_pix, c*xm_per_pix])
+
+
+class LaneFitter:
+    """Fits both lanes over a rolling window of the last window frames' power sums
+
+    Frames older by k frames are weighted by decay**k. Callers pass the fitter to the lane detectors, which
+    call it with the current frame's sums; commit() adds that frame to the window once its fit is accepted,
+    so a frame searched twice or rejected is only counted once or not at all.
+    """
+    def __init__(self, window = 1, decay = 1.0):
+        self.history = deque(maxlen = max(int(window) - 1, 0))
+        self.decay = decay
+        self.pending = None
+
+    def reset(self):
+        self.history.clear()
+        self.pending = None
+
+    def __call__(self, left_sums, right_sums):
+        current = np.stack((left_sums, right_sums))
+        self.pending = current
+        total = current.copy()
+        weight = 1.0
+        for past in reversed(self.history):
+            weight *= self.decay
+            total += weight*past
+        left_fit, right_fit = solve(total)
+        return left_fit, right_fit
+
+    def commit(self):
+        if self.pending is not None and self.history.maxlen:
+            self.history.append(self.pending)
+        self.pending = None
@@ -0,0 +1,179 @@
+import json
+import math
+import os
+import threading
+import time
+
+
+class NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_TIMER = NullTimer()
+
+
+class NullMetrics:
+    """Default metrics: every call is a no-op, so disabled instrumentation costs one method call
+    """
+    enabled = False
+
+    def time(self, stage):
+        return NULL_TIMER
+
+    def count(self, name, n = 1):
+        pass
+
+    def observe(self, name, value):
+        pass
+
+    def tick(self):
+        pass
+
+    def write(self, path = None):
+        pass
+
+
+class Histogram:
+    """Log-bucketed histogram, quantiles are accurate to one bucket (about 9%) and memory is constant
+    """
+    BUCKETS_PER_DOUBLING = 8
+
+    def __init__(self, low):
+        self.low = low
+        self.buckets = {}
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+        if value <= self.low:
+            bucket = 0
+        else:
+            bucket = int(math.log2(value/self.low)*self.BUCKETS_PER_DOUBLING) + 1
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def upper(self, bucket):
+        return self.low*2**(bucket/self.BUCKETS_PER_DOUBLING)
+
+    def quantile(self, q):
+        if self.count == 0:
+            return 0.0
+        rank = q*self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min(self.upper(bucket), self.max)
+        return self.max
+
+    def summary(self):
+        return {'count': self.count, 'sum': self.sum, 'max': self.max,
+                'p50': self.quantile(0.5), 'p95': self.quantile(0.95), 'p99': self.quantile(0.99)}
+
+
+class Timer:
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observeStage(self.stage, time.perf_counter() - self.start)
+        return False
+
+
+class Metrics:
+    """Per-stage wall-clock histograms, counters and value histograms, shared safely between threads
+
+    tick() rewrites path at most every interval seconds and write() flushes it at the end of a run; a path
+    ending in .prom is written in the Prometheus text format, anything else as JSON. Without a path
+    nothing is written.
+    """
+    enabled = True
+
+    def __init__(self, path = None, interval = 5.0):
+        self.path = path
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.values = {}
+        self.counters = {}
+        self.last_write = time.monotonic()
+
+    def time(self, stage):
+        return Timer(self, stage)
+
+    def observeStage(self, stage, seconds):
+        with self.lock:
+            histogram = self.stages.get(stage)
+            if histogram is None:
+                histogram = self.stages[stage] = Histogram(1e-6)
+            histogram.add(seconds)
+
+    def observe(self, name, value):
+        with self.lock:
+            histogram = self.values.get(name)
+            if histogram is None:
+                histogram = self.values[name] = Histogram(1.0)
+            histogram.add(value)
+
+    def count(self, name, n = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'stages': {stage: h.summary() for stage, h in self.stages.items()},
+                'values': {name: h.summary() for name, h in self.values.items()},
+                'counters': dict(self.counters),
+            }
+
+    def tick(self):
+        if self.path is not None and time.monotonic() - self.last_write >= self.interval:
+            self.write()
+
+    def write(self, path = None):
+        path = path or self.path
+        self.last_write = time.monotonic()
+        if path is None:
+            return
+        snapshot = self.snapshot()
+        if path.endswith('.prom'):
+            text = prometheusText(snapshot)
+        else:
+            text = json.dumps(snapshot, indent = 2, sort_keys = True)
+        # Scrapers never see a half written file
+        tmp_path = path + '.%d.tmp' % os.getpid()
+        with open(tmp_path, 'w') as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+
+
+def prometheusText(snapshot, prefix = 'lane'):
+    lines = []
+
+    def summary(name, label, summaries):
+        lines.append('# TYPE %s summary' % name)
+        for key, s in sorted(summaries.items()):
+            for q in ('p50', 'p95', 'p99'):
+                lines.append('%s{%s="%s",quantile="0.%s"} %r' % (name, label, key, q[1:], s[q]))
+            lines.append('%s_sum{%s="%s"} %r' % (name, label, key, s['sum']))
+            lines.append('%s_count{%s="%s"} %d' % (name, label, key, s['count']))
+
+    summary(prefix + '_stage_seconds', 'stage', snapshot['stages'])
+    summary(prefix + '_value', 'name', snapshot['values'])
+    for name, value in sorted(snapshot['counters'].items()):
+        lines.append('# TYPE %s_%s_total counter' % (prefix, name))
+        lines.append('%s_%s_total %d' % (prefix, name, value))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,413 @@
+import numpy as np
+import cv2
+
+from . import calibration
+from . import debug
+from . import fused
+from . import lanefit
+from . import metrics as lanemetrics
+from . import pixelindex
+from . import remap
+from . import threshold
+from . import tracker as lanetracker
+from . import utils
+
+
+def claheWindow(region, size, grid = (8, 8)):
+    """Returns (x0, y0, x1, y1), the whole CLAHE tiles of a frame of size needed to equalize its region
+
+    CLAHE blends each pixel between its nearest tile centres, so the window reaches half a tile past region
+    and out to the tile borders; equalized on its own with the same tile size it then reproduces the whole
+    frame within region. Frames that do not split into whole tiles get the full frame.
+    """
+    width, height = size
+    if width % grid[0] or height % grid[1]:
+        return 0, 0, width, height
+    window = []
+    for low, high, tile, count in ((region[0], region[2], width // grid[0], grid[0]),
+                                   (region[1], region[3], height // grid[1], grid[1])):
+        first = max((2*low - tile) // (2*tile), 0)
+        last = min((2*(high - 1) - tile) // (2*tile) + 1, count - 1)
+        window.append((first*tile, (last + 1)*tile))
+    (x0, x1), (y0, y1) = window
+    return x0, y0, x1, y1
+
+
+class LanePipeline:
+    """Per-stream lane detection: calibration, tracking state and reusable scratch buffers
+
+    Replaces the global left_fit / right_fit of main.process_image. Instances share nothing, so several
+    streams can run side by side in one process. Scratch buffers are sized on the first frame and only
+    reallocated when the frame size changes.
+
+    With a remap.Roi the frame is warped straight into that smaller processing grid and thresholded and
+    searched there; margins are given in full bird's-eye pixels and the tracked fits are always stored in
+    full bird's-eye pixels, so rendering and curvature are unchanged.
+
+    fit_window > 1 fits each lane over the pixels of the last fit_window accepted frames, older frames
+    weighted by fit_decay per frame, see lanefit.LaneFitter.
+
+    track_every = N replaces the per-frame fits with a tracker.LaneTracker: detections are Kalman filtered
+    and scored, and while the confidence is high only every Nth frame is thresholded and searched, the
+    others reuse the prediction. The full sliding window search only runs when the confidence collapses.
+    """
+    def __init__(self, cal, tables = None, margin = 50, nwindows = 8, prev_margin = 20, v_thresh=(210, 255),
+                 b_thresh=(140, 255), hx_thresh=(20, 80), minpix = 20, sink = None, metrics = None, roi = None, roi_tables = None,
+                 fit_window = 1, fit_decay = 1.0, track_every = None):
+        self.config = dict(margin = margin, nwindows = nwindows, prev_margin = prev_margin, v_thresh = v_thresh,
+                           b_thresh = b_thresh, hx_thresh = hx_thresh, minpix = minpix, sink = sink, metrics = metrics, roi = roi,
+                           fit_window = fit_window, fit_decay = fit_decay, track_every = track_every)
+        # debug.NullSink by default, a debug.DebugRecorder saves the intermediates of sampled frames
+        self.sink = sink if sink is not None else debug.NullSink()
+        # metrics.NullMetrics by default, a metrics.Metrics collects per-stage timings and counters
+        self.metrics = metrics if metrics is not None else lanemetrics.NullMetrics()
+        self.frame_index = 0
+        self.cal = cal
+        self.tables = tables if tables is not None else remap.getRemapTables(cal)
+        self.roi = roi
+        if roi is None:
+            self.roi_tables = self.tables
+        else:
+            self.roi_tables = roi_tables if roi_tables is not None else remap.getRemapTables(cal, roi = roi)
+        scale = roi.scale if roi is not None else 1
+        self.margin = max(int(round(margin*scale)), 1)
+        self.prev_margin = max(int(round(prev_margin*scale)), 1)
+        # minpix counts pixels, which shrink with the area
+        self.minpix = max(int(round(minpix*scale*scale)), 1)
+        self.nwindows = nwindows
+        self.fitter = lanefit.LaneFitter(fit_window, fit_decay)
+        # lane pixel counts on the processing grid -> full resolution
+        self.count_scale = 1 / (scale*scale)
+        self.tracker = None
+        if track_every is not None:
+            # DST_POINTS put the lanes 500 px apart in a 1280 px wide bird's-eye view
+            width, height = self.tables.warped_size
+            lane_width = np.ptp(calibration.DST_POINTS[:, 0]) * width / 1280
+            self.tracker = lanetracker.LaneTracker((width, height), lane_width, every = track_every)
+        self.clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8,8))
+        self.engine = threshold.ThresholdEngine(v_thresh, b_thresh, hx_thresh, reuse_buffers = True)
+        # Built by fusedThreshold() on first use, its color table takes a moment
+        self.fused = None
+        # Built by fullResolution() when a fit on the Roi grid fails
+        self.full = None
+        self.buffers = {}
+        self.shape = None
+        self.window = None
+        self.reset()
+
+    def clone(self):
+        """Returns a new pipeline with the same calibration and settings but fresh state and buffers
+        """
+        return LanePipeline(self.cal, self.tables, roi_tables = self.roi_tables, **self.config)
+
+    def reset(self):
+        self.left_fit = None
+        self.right_fit = None
+        self.fitter.reset()
+        if self.tracker is not None:
+            self.tracker.reset()
+
+    def allocate(self, img):
+        if img.shape == self.shape:
+            return
+        # CLAHE runs on the part of the camera frame the warp reads, the bird's-eye buffer follows the remap
+        # tables and the channel count
+        size = (img.shape[1], img.shape[0])
+        region = remap.sampledRegion(self.roi_tables) if self.roi_tables.img_size == size else (0, 0) + size
+        grid = self.clahe.getTilesGridSize()
+        x0, y0, x1, y1 = self.window = claheWindow(region, size, grid)
+        tiles = ((x1 - x0)*grid[0] // size[0], (y1 - y0)*grid[1] // size[1])
+        self.window_clahe = cv2.createCLAHE(clipLimit=self.clahe.getClipLimit(), tileGridSize=tiles)
+        window_shape = (y1 - y0, x1 - x0)
+        warped_shape = (self.roi_tables.warped_size[1], self.roi_tables.warped_size[0]) + img.shape[2:]
+        self.buffers = {
+            'warpped': np.empty(warped_shape, np.uint8),
+            'lab': np.empty(window_shape + img.shape[2:], np.uint8),
+            'lightness': np.empty(window_shape, np.uint8),
+            'equalized': np.empty(window_shape, np.uint8),
+            'clahe': np.zeros(img.shape, np.uint8),
+        }
+        self.shape = img.shape
+
+    def equalize(self, img, dst = None):
+        """Returns img CLAHE equalized like utils.getCLAHE where warp() reads it, in dst or a reused buffer
+
+        Only self.window, the whole CLAHE tiles around the pixels the warp samples, is equalized; the rest of
+        dst is left as it was. Within the sampled pixels it matches equalizing the whole frame to a grey level or two.
+        """
+        self.allocate(img)
+        buffers = self.buffers
+        x0, y0, x1, y1 = self.window
+        if dst is None:
+            dst = buffers['clahe']
+        lab = cv2.cvtColor(img[y0:y1, x0:x1], cv2.COLOR_RGB2LAB, dst=buffers['lab'])
+        lightness = cv2.extractChannel(lab, 0, dst=buffers['lightness'])
+        equalized = self.window_clahe.apply(lightness, dst=buffers['equalized'])
+        lab = cv2.insertChannel(equalized, lab, 0)
+        # The window of dst is a strided view, OpenCV writes into it as long as shape and type match
+        cv2.cvtColor(lab, cv2.COLOR_LAB2RGB, dst=dst[y0:y1, x0:x1])
+        return dst
+
+    def binary(self, img, sink = debug.NULL_FRAME):
+        """Returns the thresholded bird's-eye bitmask.PackedMask of a raw camera frame on the processing grid
+        """
+        return self.thresholdWarped(self.equalizeWarp(img, sink), sink)
+
+    def equalizeWarp(self, img, sink = debug.NULL_FRAME):
+        """Returns a raw camera frame CLAHE equalized and warped onto the processing grid, valid until the next frame
+
+        CLAHE runs on the camera frame as in utils.getPerspectiveBinary, its tiles then cover the same scene
+        as without the fused remap; equalizing the bird's-eye view moves the fitted lanes.
+        """
+        with self.metrics.time('clahe'):
+            clahe = self.equalize(img)
+        if sink.active:
+            x0, y0, x1, y1 = self.window
+            sink.image('clahe', clahe[y0:y1, x0:x1])
+        return self.warp(clahe)
+
+    def pixels(self, img, sink = debug.NULL_FRAME):
+        """Returns the pixelindex.RowPixelIndex of binary(img), straight from the warped frame when possible
+
+        Feed it to track(None, sink, index). Without an active sink fused.FusedThreshold finds the pixels in
+        one pass and no full-frame binary is built.
+        """
+        if sink.active:
+            # The debug images need the intermediate binaries
+            return pixelindex.RowPixelIndex.fromBinary(self.binary(img, sink))
+        warpped = self.equalizeWarp(img)
+        with self.metrics.time('threshold'):
+            return self.fusedThreshold()(warpped)
+
+    def fusedThreshold(self):
+        """Returns the fused.FusedThreshold of this pipeline's thresholds, built on first use
+        """
+        if self.fused is None:
+            self.fused = fused.FusedThreshold(self.engine)
+        return self.fused
+
+    def warp(self, img):
+        """Returns a raw camera frame warped onto the processing grid, valid until the next frame
+        """
+        self.allocate(img)
+        with self.metrics.time('warp'):
+            return remap.warpFrame(img, self.roi_tables, dst = self.buffers['warpped'])
+
+    def thresholdWarped(self, warpped, sink = debug.NULL_FRAME):
+        """Returns the bitmask.PackedMask of a frame already equalized and warped onto the processing grid, see equalizeWarp()
+        """
+        with self.metrics.time('threshold'):
+            mask, channel_masks = self.engine.applyPacked(warpped, debug = sink.active)
+        if sink.active:
+            sink.image('warped', warpped)
+            l_channel, b_channel, s_channel = self.engine.channels(warpped)
+            sink.image('channels', debug.panel([l_channel, b_channel, s_channel] + [m.toBinary() for m in channel_masks]))
+            sink.image('binary', mask.toBinary())
+        return mask
+
+    def track(self, binary_warped, sink = debug.NULL_FRAME, index = None, frame = None):
+        """Updates and returns the (left_fit, right_fit) tracking state from a processing grid binary or PackedMask
+
+        index is the pixelindex.RowPixelIndex of binary_warped when the caller already has it, binary_warped
+        may then be None, see pixels(). frame is the raw camera frame, with a Roi it lets a failed grid fit be
+        searched again at full resolution, see search().
+        """
+        metrics = self.metrics
+        metrics.count('frames')
+        # Both searches share one row-sorted index of the lit pixels
+        if index is None:
+            with metrics.time('index'):
+                index = pixelindex.RowPixelIndex.fromBinary(binary_warped)
+        metrics.observe('lit_pixels', len(index))
+        if self.tracker is not None:
+            return self.trackConfident(binary_warped, index, sink, frame)
+        try:
+            if self.left_fit is not None and self.right_fit is not None:
+                left_fit, right_fit = self.search(binary_warped, index, sink, True, frame)
+                if utils.needRecalculateLeftAndRightLane(self.left_fit, self.right_fit):
+                    metrics.count('full_searches')
+                    left_fit, right_fit = self.search(binary_warped, index, sink, False, frame)
+            else:
+                metrics.count('initial_searches')
+                left_fit, right_fit = self.search(binary_warped, index, sink, False, frame)
+        except (TypeError, ValueError, np.linalg.LinAlgError):
+            # Fitting fails when a lane has no pixels; keep the previous fits when there are any
+            metrics.count('failed_fits')
+            if self.left_fit is None or self.right_fit is None:
+                raise
+            metrics.count('dropped_frames')
+            sink.event('failed_fit')
+            metrics.tick()
+            return self.left_fit, self.right_fit
+
+        self.fitter.commit()
+        self.left_fit = utils.smooth(self.left_fit, left_fit, coeficient = 1)
+        self.right_fit = utils.smooth(self.right_fit, right_fit, coeficient = 1)
+        metrics.tick()
+        return self.left_fit, self.right_fit
+
+    def search(self, binary_warped, index, sink, band, frame = None):
+        """Returns the full bird's-eye (left_fit, right_fit) of a band search around the tracked fits or a full search
+
+        On a remap.Roi grid a fit from too few pixels, or one that leaves the view, is searched again at full
+        resolution when the raw frame is given and raises ValueError otherwise.
+        """
+        if band:
+            with self.metrics.time('detect_band'):
+                left_fit, right_fit = utils.detectLanesWithPreFram(binary_warped, self.prev_margin, self.toGrid(self.left_fit),
+                                                                   self.toGrid(self.right_fit), index = index, sink = sink,
+                                                                   fitter = self.fitter)
+        else:
+            with self.metrics.time('detect_windows'):
+                left_fit, right_fit = utils.detectLanesWithoutPreFrame(binary_warped, self.margin, self.nwindows, self.minpix,
+                                                                       index = index, sink = sink, fitter = self.fitter)
+        left_fit, right_fit = self.fromGrid(left_fit), self.fromGrid(right_fit)
+        if self.roi is None or self.plausible(left_fit, right_fit):
+            return left_fit, right_fit
+        if frame is None:
+            raise ValueError('implausible fit on the ROI grid')
+        self.metrics.count('roi_fallbacks')
+        return self.searchFull(frame, sink, band)
+
+    def plausible(self, left_fit, right_fit):
+        # A few pixels on the coarse grid can bend a fit far out of the view
+        counts = self.fitter.pending[:, 0]*self.count_scale
+        if counts.min() < self.config['minpix']*self.nwindows:
+            return False
+        width, height = self.tables.warped_size
+        x = np.polyval(np.stack((left_fit, right_fit)).T, [[0], [height - 1]])
+        return bool(np.all((x > -width) & (x < 2*width)))
+
+    def fullResolution(self):
+        """Returns the pipeline without Roi that searches the full bird's-eye view when a grid fit fails, built on first use
+        """
+        if self.full is None:
+            config = dict(self.config, roi = None, sink = None, track_every = None)
+            self.full = LanePipeline(self.cal, self.tables, **config)
+        return self.full
+
+    def searchFull(self, frame, sink, band):
+        # search() on the full bird's-eye view of frame; the power sums are moved onto the grid, so the fitter's
+        # window and the pixel counts stay in grid terms
+        full = self.fullResolution()
+        index = full.pixels(frame)
+        roi = self.roi
+
+        def fitter(left_sums, right_sums):
+            return self.fitter(lanefit.scaleSums(left_sums, roi.scale, roi.x, roi.y, roi.scale**2),
+                               lanefit.scaleSums(right_sums, roi.scale, roi.x, roi.y, roi.scale**2))
+
+        if band:
+            with self.metrics.time('detect_band'):
+                left_fit, right_fit = utils.detectLanesWithPreFram(None, full.prev_margin, self.left_fit, self.right_fit,
+                                                                   index = index, sink = sink, fitter = fitter)
+        else:
+            with self.metrics.time('detect_windows'):
+                left_fit, right_fit = utils.detectLanesWithoutPreFrame(None, full.margin, full.nwindows, full.minpix,
+                                                                       index = index, sink = sink, fitter = fitter)
+        return self.fromGrid(left_fit), self.fromGrid(right_fit)
+
+    def trackConfident(self, binary_warped, index, sink = debug.NULL_FRAME, frame = None):
+        # track() with a LaneTracker: band search while confident, full search when the confidence collapsed
+        metrics = self.metrics
+        tracker = self.tracker
+        tracker.predict()
+        # (score, left_fit, right_fit, fitter pending) of the best search so far
+        best = None
+        for band in ((True, False) if not tracker.collapsed() else (False,)):
+            if not band:
+                metrics.count('full_searches')
+            try:
+                left_fit, right_fit = self.search(binary_warped, index, sink, band, frame)
+            except (TypeError, ValueError, np.linalg.LinAlgError):
+                metrics.count('failed_fits')
+                continue
+            score = tracker.score(left_fit, right_fit, self.fitter.pending[:, 0]*self.count_scale)
+            if best is None or score > best[0]:
+                best = (score, left_fit, right_fit, self.fitter.pending)
+            if score >= tracker.low:
+                break
+        score = best[0] if best is not None else 0.0
+        metrics.observe('confidence', 100*score)
+        # Without an estimate yet any fit seeds the tracker, a zero score only means the lanes look unlikely;
+        # update() then weighs it with the largest measurement noise and the confidence stays collapsed
+        if best is not None and (score > 0 or tracker.x is None):
+            score, left_fit, right_fit, self.fitter.pending = best
+            self.fitter.commit()
+            self.left_fit, self.right_fit = tracker.update(left_fit, right_fit, score)
+        else:
+            tracker.miss()
+            if tracker.x is None:
+                raise ValueError('no lanes found')
+            metrics.count('dropped_frames')
+            sink.event('failed_fit')
+            self.left_fit, self.right_fit = tracker.fits
+        metrics.tick()
+        return self.left_fit, self.right_fit
+
+    def scheduleDetection(self):
+        """Returns whether the next frame has to go through pixels() and track(), otherwise call coast()
+
+        Call exactly once per frame in frame order.
+        """
+        return self.tracker is None or self.tracker.schedule()
+
+    def detectionDue(self):
+        """Returns whether a frame scheduleDetection() let skip has to be detected after all, see LaneTracker.overdue
+
+        Streams schedule frames ahead of tracking them; detect such a frame instead of calling coast() when
+        this holds by the time it is tracked.
+        """
+        return self.tracker is not None and self.tracker.overdue()
+
+    def coast(self, sink = debug.NULL_FRAME):
+        """Advances the tracker over a frame that is not detected and returns its predicted fits
+        """
+        self.metrics.count('frames')
+        self.metrics.count('skipped_frames')
+        sink.event('predicted')
+        self.tracker.coast()
+        self.left_fit, self.right_fit = self.tracker.fits
+        self.metrics.tick()
+        return self.left_fit, self.right_fit
+
+    def toGrid(self, fit):
+        # full bird's-eye fit -> processing grid fit
+        return fit if self.roi is None else remap.fitToRoi(fit, self.roi)
+
+    def fromGrid(self, fit):
+        return fit if self.roi is None else remap.fitFromRoi(fit, self.roi)
+
+    def render(self, img, left_fit = None, right_fit = None, out = None, sink = debug.NULL_FRAME):
+        """Draws the given fits, or the tracked ones, onto a raw camera frame
+        """
+        if left_fit is None or right_fit is None:
+            left_fit, right_fit = self.left_fit, self.right_fit
+        with self.metrics.time('render'):
+            result = utils.drawDetectedBoundary(img, self.cal.inverseM, left_fit, right_fit, tables = self.tables,
+                                                out = out)
+        if sink.active:
+            sink.image('result', result)
+        return result
+
+    def nextFrame(self):
+        """Returns the debug handle of the next frame, NULL_FRAME unless the sink samples it
+        """
+        sink = self.sink.frame(self.frame_index)
+        self.frame_index += 1
+        return sink
+
+    def process(self, img, out = None):
+        """Returns img with the detected lane drawn on it, drop-in replacement for main.process_image
+
+        The result is written to out when given, otherwise a new frame is returned so callers may keep it.
+        """
+        sink = self.nextFrame()
+        with self.metrics.time('frame'):
+            if self.scheduleDetection():
+                self.track(None, sink, self.pixels(img, sink), img)
+            else:
+                self.coast(sink)
+            return self.render(img, out = out, sink = sink)
+
+    __call__ = process
@@ -0,0 +1,101 @@
+import numpy as np
+
+from . import bitmask
+
+
+class RowPixelIndex:
+    """Lit pixels of a binary image sorted by row, with the start offset of every row
+
+    binary.nonzero() already returns pixels in row-major order, so a y-band [y_low, y_high) is the
+    contiguous slice y[row_start[y_low]:row_start[y_high]] and only that slice has to be searched for x.
+
+    Producers that already know them, like fused.FusedThreshold, pass row_start and a precomputed
+    (y_low, y_high, counts) column histogram.
+    """
+    def __init__(self, nonzeroy, nonzerox, shape, row_start = None, histogram = None):
+        self.y = nonzeroy
+        self.x = nonzerox
+        self.shape = shape
+        if row_start is None:
+            counts = np.bincount(nonzeroy, minlength = shape[0])
+            row_start = np.zeros(shape[0] + 1, np.intp)
+            np.cumsum(counts, out = row_start[1:])
+        self.row_start = row_start
+        self.histogram = histogram
+        self._keys = None
+
+    @classmethod
+    def fromBinary(cls, binary):
+        """Returns the index of a 0/1 binary image or a bitmask.PackedMask
+        """
+        if isinstance(binary, bitmask.PackedMask):
+            return cls.fromMask(binary)
+        if binary.dtype == np.uint8 or binary.dtype == np.bool_:
+            # Packing and expanding only the non-zero bytes is ~3x faster than nonzero() on the full binary
+            return cls.fromMask(bitmask.PackedMask.fromBinary(binary))
+        nonzeroy, nonzerox = binary.nonzero()
+        return cls(nonzeroy, nonzerox, binary.shape[:2])
+
+    @classmethod
+    def fromMask(cls, mask):
+        nonzeroy, nonzerox = mask.nonzero()
+        return cls(nonzeroy, nonzerox, mask.shape)
+
+    def toBinary(self):
+        """Returns the 0/1 uint8 binary image of the pixels
+        """
+        binary = np.zeros(self.shape, np.uint8)
+        binary[self.y, self.x] = 1
+        return binary
+
+    def __len__(self):
+        return len(self.y)
+
+    def band(self, y_low, y_high):
+        """Returns the (start, stop) slice of the pixels with y_low <= y < y_high
+        """
+        y_low = min(max(int(y_low), 0), self.shape[0])
+        y_high = min(max(int(y_high), y_low), self.shape[0])
+        return self.row_start[y_low], self.row_start[y_high]
+
+    def window(self, y_low, y_high, x_low, x_high):
+        """Returns the ascending indices of the pixels with y_low <= y < y_high and x_low <= x < x_high
+        """
+        start, stop = self.band(y_low, y_high)
+        band_x = self.x[start:stop]
+        return ((band_x >= x_low) & (band_x < x_high)).nonzero()[0] + start
+
+    @property
+    def keys(self):
+        # y*width + x is strictly increasing, so per-row x ranges can be binary searched
+        if self._keys is None:
+            self._keys = self.y.astype(np.int64)*self.shape[1] + self.x
+        return self._keys
+
+    def curveBand(self, centers, margin):
+        """Returns the ascending indices of the pixels with centers[y] - margin < x < centers[y] + margin
+
+        centers holds one x per image row, so the curve is evaluated per row instead of per lit pixel.
+        """
+        height, width = self.shape
+        low = centers - margin
+        high = centers + margin
+        valid = np.isfinite(low) & np.isfinite(high)
+        # Integer x satisfies low < x < high exactly when floor(low) + 1 <= x < ceil(high)
+        x_first = np.where(valid, np.clip(np.floor(np.where(valid, low, 0)) + 1, 0, width), width).astype(np.int64)
+        x_stop = np.where(valid, np.clip(np.ceil(np.where(valid, high, 0)), 0, width), 0).astype(np.int64)
+        row_keys = np.arange(height, dtype=np.int64)*width
+        start = np.searchsorted(self.keys, row_keys + x_first)
+        stop = np.maximum(np.searchsorted(self.keys, row_keys + x_stop), start)
+
+        lengths = stop - start
+        offsets = np.cumsum(lengths) - lengths
+        return np.arange(lengths.sum()) + np.repeat(start - offsets, lengths)
+
+    def columnHistogram(self, y_low, y_high):
+        """Returns the number of lit pixels per column within y_low <= y < y_high
+        """
+        if self.histogram is not None and self.histogram[:2] == (y_low, y_high):
+            return self.histogram[2]
+        start, stop = self.band(y_low, y_high)
+        return np.bincount(self.x[start:stop], minlength = self.shape[1])
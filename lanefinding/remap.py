@@ -0,0 +1,165 @@
+import os
+from collections import namedtuple
+
+import numpy as np
+import cv2
+
+from . import calibration
+
+# Fixed-point (CV_16SC2 + CV_16UC1) lookup tables, see cv2.convertMaps
+RemapTables = namedtuple('RemapTables', ['warp_map1', 'warp_map2', 'undistort_map1', 'undistort_map2',
+                                         'img_size', 'warped_size'])
+# The arrays of RemapTables, what the cache files hold
+MAP_FIELDS = RemapTables._fields[:4]
+# Processing grid: the rectangle (x, y, width, height) of the full bird's-eye view resampled by scale
+Roi = namedtuple('Roi', ['x', 'y', 'width', 'height', 'scale'])
+
+
+def pixelGrid(size):
+    """Returns the (x, y) float64 coordinates of every pixel of an image of size (width, height)
+    """
+    x, y = np.meshgrid(np.arange(size[0], dtype=np.float64), np.arange(size[1], dtype=np.float64))
+    return x, y
+
+
+def applyHomography(H, x, y):
+    w = H[2, 0]*x + H[2, 1]*y + H[2, 2]
+    return (H[0, 0]*x + H[0, 1]*y + H[0, 2]) / w, (H[1, 0]*x + H[1, 1]*y + H[1, 2]) / w
+
+
+def distortPixels(x, y, mtx, dist):
+    # Undistorted pixel -> normalized camera coordinates -> distorted (raw) pixel
+    xn = (x - mtx[0, 2]) / mtx[0, 0]
+    yn = (y - mtx[1, 2]) / mtx[1, 1]
+    objpoints = np.dstack((xn.ravel(), yn.ravel(), np.ones(xn.size))).reshape(-1, 1, 3)
+    zero = np.zeros(3)
+    imgpoints, _ = cv2.projectPoints(objpoints, zero, zero, mtx, dist)
+    return imgpoints[:, 0, 0].reshape(x.shape), imgpoints[:, 0, 1].reshape(x.shape)
+
+
+def toFixedPoint(mapx, mapy):
+    return cv2.convertMaps(mapx.astype(np.float32), mapy.astype(np.float32), cv2.CV_16SC2)
+
+
+def buildRemapTables(mtx, dist, M, img_size, warped_size = None):
+    """Returns RemapTables composing the lens undistortion with the perspective transform M
+
+    warp: raw camera frame -> bird's-eye view, one resample instead of undistort + warpPerspective; its
+    map1 / map2 also give the raw frame position of bird's-eye points, see warpedToFrame
+    undistort: raw camera frame -> undistorted frame, the cached maps cv2.undistort rebuilds per call
+    """
+    if warped_size is None:
+        warped_size = img_size
+    inverseM = np.linalg.inv(M)
+
+    # For every bird's-eye pixel find where it came from in the raw frame
+    x, y = pixelGrid(warped_size)
+    x, y = applyHomography(inverseM, x, y)
+    warp_map1, warp_map2 = toFixedPoint(*distortPixels(x, y, mtx, dist))
+
+    undistort_map1, undistort_map2 = cv2.initUndistortRectifyMap(mtx, dist, None, mtx, img_size, cv2.CV_16SC2)
+
+    return RemapTables(warp_map1, warp_map2, undistort_map1, undistort_map2, tuple(img_size), tuple(warped_size))
+
+
+def warpFrame(img, tables, dst = None):
+    return cv2.remap(img, tables.warp_map1, tables.warp_map2, cv2.INTER_LINEAR, dst = dst)
+
+
+def undistortFrame(img, tables, dst = None):
+    return cv2.remap(img, tables.undistort_map1, tables.undistort_map2, cv2.INTER_LINEAR, dst = dst)
+
+
+def sampledRegion(tables):
+    """Returns (x0, y0, x1, y1), the box of raw frame pixels warpFrame reads, bilinear neighbours included
+    """
+    width, height = tables.img_size
+    xy = tables.warp_map1.reshape(-1, 2)
+    # Positions outside the frame only read the constant border
+    inside = (xy[:, 0] >= -1) & (xy[:, 0] < width) & (xy[:, 1] >= -1) & (xy[:, 1] < height)
+    if not inside.any():
+        return 0, 0, width, height
+    low = np.maximum(xy[inside].min(axis = 0), 0)
+    high = np.minimum(xy[inside].max(axis = 0).astype(int) + 2, (width, height))
+    return int(low[0]), int(low[1]), int(high[0]), int(high[1])
+
+
+def warpedToFrame(points, tables):
+    """Returns the raw frame coordinates of (N, 2) bird's-eye points, read from the fixed-point warp table
+
+    Points are rounded to the nearest bird's-eye pixel and clipped to the bird's-eye view.
+    """
+    width, height = tables.warped_size
+    x = np.clip(np.rint(points[:, 0]), 0, width - 1).astype(np.intp)
+    y = np.clip(np.rint(points[:, 1]), 0, height - 1).astype(np.intp)
+    # map2 holds the 5+5 bit fractional position, see cv2.INTER_TAB_SIZE
+    frac = tables.warp_map2[y, x]
+    frame_x = tables.warp_map1[y, x, 0] + (frac & 31) / 32.0
+    frame_y = tables.warp_map1[y, x, 1] + (frac >> 5) / 32.0
+    return np.column_stack((frame_x, frame_y))
+
+
+def laneRoi(warped_size, scale = 0.5, margin = 200, dst = calibration.DST_POINTS, reference_size = (1280, 720)):
+    """Returns the full-height Roi spanning the lanes of dst plus margin on each side
+
+    dst and margin are in reference_size pixels and rescaled to warped_size.
+    """
+    sx = warped_size[0] / reference_size[0]
+    x_low = max(int((dst[:, 0].min() - margin)*sx), 0)
+    x_high = min(int(np.ceil((dst[:, 0].max() + margin)*sx)), warped_size[0])
+    return Roi(x_low, 0, x_high - x_low, warped_size[1], scale)
+
+
+def roiSize(roi):
+    return int(round(roi.width*roi.scale)), int(round(roi.height*roi.scale))
+
+
+def roiMatrix(roi):
+    # full bird's-eye pixel -> processing grid pixel
+    s = roi.scale
+    return np.array([[s, 0, -s*roi.x], [0, s, -s*roi.y], [0, 0, 1]], np.float64)
+
+
+def fitToRoi(fit, roi):
+    """Returns the x = f(y) polynomial of a full bird's-eye fit in processing grid pixels
+    """
+    a, b, c = fit
+    s, y0 = roi.scale, roi.y
+    return np.array([a/s, 2*a*y0 + b, s*(a*y0**2 + b*y0 + c - roi.x)])
+
+
+def fitFromRoi(fit, roi):
+    """Returns the x = f(y) polynomial of a processing grid fit in full bird's-eye pixels, inverse of fitToRoi
+    """
+    a, b, c = fit
+    s, y0 = roi.scale, roi.y
+    return np.array([a*s, b - 2*a*s*y0, a*s*y0**2 - b*y0 + c/s + roi.x])
+
+
+def getRemapTables(cal, warped_size = None, cache_dir = calibration.CACHE_DIR, roi = None):
+    """Returns the RemapTables for a Calibration, cached next to the calibration artifact
+
+    With a Roi the warp goes straight from the raw frame into the processing grid, warped_size is ignored.
+    """
+    M = cal.M
+    if roi is not None:
+        M = roiMatrix(roi) @ M
+        warped_size = roiSize(roi)
+        fname = 'remap-%s-roi-%g-%g-%g-%g-%g.npz' % ((cal.key,) + tuple(roi))
+    else:
+        if warped_size is None:
+            warped_size = cal.img_size
+        fname = 'remap-%s-%dx%d.npz' % (cal.key, warped_size[0], warped_size[1])
+    path = os.path.join(cache_dir, fname)
+    if os.path.exists(path):
+        with np.load(path) as data:
+            return RemapTables(*[data[name] for name in MAP_FIELDS],
+                               tuple(cal.img_size), tuple(warped_size))
+
+    tables = buildRemapTables(cal.mtx, cal.dist, M, cal.img_size, warped_size)
+    os.makedirs(cache_dir, exist_ok = True)
+    tmp_path = path + '.%d.tmp' % os.getpid()
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, **{name: getattr(tables, name) for name in MAP_FIELDS})
+    os.replace(tmp_path, path)
+    return tables
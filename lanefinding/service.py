@@ -0,0 +1,402 @@
+import argparse
+import asyncio
+import itertools
+import json
+import struct
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import cv2
+
+from . import bitmask
+from . import calibration
+from . import metrics as lanemetrics
+from . import pipeline
+from . import remap
+from . import utils
+
+# Every message is a 4 byte big-endian header length, a JSON header and header['size'] payload bytes
+HEADER = struct.Struct('>I')
+MAX_HEADER = 1 << 16
+POLICIES = ('drop_oldest', 'drop_newest', 'block')
+
+# Per worker process, set up once by initWorker
+_worker = {}
+
+
+def packMessage(header, payload = b''):
+    header = json.dumps(dict(header, size = len(payload))).encode()
+    return HEADER.pack(len(header)) + header + payload
+
+
+async def readMessage(reader):
+    """Returns the next (header, payload) of a stream, (None, None) when the peer closed it
+    """
+    try:
+        size, = HEADER.unpack(await reader.readexactly(HEADER.size))
+        if size > MAX_HEADER:
+            raise ValueError('header of %d bytes' % size)
+        header = json.loads(await reader.readexactly(size))
+        payload = await reader.readexactly(header.get('size', 0))
+    except asyncio.IncompleteReadError:
+        return None, None
+    return header, payload
+
+
+def initWorker(pattern, roi):
+    cal = calibration.getCalibration(pattern)
+    _worker['pipeline'] = pipeline.LanePipeline(cal, remap.getRemapTables(cal), roi = roi)
+
+
+def decodeFrame(header, payload):
+    # raw frames are RGB uint8 of header['shape'], anything else is an encoded image cv2 can read
+    if header.get('encoding', 'jpeg') == 'raw':
+        return np.frombuffer(payload, np.uint8).reshape(header['shape'])
+    img = cv2.imdecode(np.frombuffer(payload, np.uint8), cv2.IMREAD_COLOR)
+    if img is None:
+        raise ValueError('cannot decode frame')
+    return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+
+
+def binaryJob(header, payload):
+    """Decodes a frame and returns the bits and width of its bird's-eye bitmask.PackedMask
+    """
+    index = _worker['pipeline'].pixels(decodeFrame(header, payload))
+    mask = bitmask.PackedMask.fromPixels(index.y, index.x, index.shape)
+    return mask.bits, mask.width
+
+
+def renderJob(header, payload, left_fit, right_fit):
+    """Decodes a frame and returns the JPEG of the lane drawn on it
+    """
+    img = decodeFrame(header, payload)
+    result = _worker['pipeline'].render(img, np.array(left_fit), np.array(right_fit))
+    return cv2.imencode('.jpg', cv2.cvtColor(result, cv2.COLOR_RGB2BGR))[1].tobytes()
+
+
+class Session:
+    """Tracking state and frame queue of one client stream
+
+    Frames wait in a queue of queue_size; when it is full the policy drops the oldest queued frame, drops the
+    new one, or blocks, which stops reading the socket and pushes back on the client. At most depth frames
+    of a session are in the shared pool at once, so a fast stream cannot crowd out the others. When the
+    client goes away run() ends and later frames are ignored, nothing waits on the dead stream.
+    """
+    def __init__(self, service, sid, writer, track_every = None, policy = 'drop_oldest', queue_size = 4, depth = 2):
+        if policy not in POLICIES:
+            raise ValueError('unknown policy %r' % policy)
+        self.service = service
+        self.sid = sid
+        self.writer = writer
+        self.policy = policy
+        self.depth = max(int(depth), 1)
+        self.queue = asyncio.Queue(max(int(queue_size), 1))
+        self.pipeline = pipeline.LanePipeline(service.cal, service.tables, roi = service.roi,
+                                              track_every = track_every, metrics = service.metrics)
+        self.stats = {'received': 0, 'processed': 0, 'dropped': 0, 'failed': 0}
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    def reply(self, header, payload = b''):
+        if not self.writer.is_closing():
+            self.writer.write(packMessage(dict(header, session = self.sid), payload))
+
+    def drop(self, header):
+        self.stats['dropped'] += 1
+        self.service.metrics.count('service_dropped')
+        self.reply({'op': 'result', 'seq': header.get('seq'), 'dropped': True})
+
+    async def put(self, item):
+        # Waits for room in the queue unless run() ended, returns whether item was queued
+        put = asyncio.ensure_future(self.queue.put(item))
+        await asyncio.wait((put, self.task), return_when = asyncio.FIRST_COMPLETED)
+        if not put.done():
+            put.cancel()
+            return False
+        return True
+
+    async def push(self, header, payload):
+        if self.task.done():
+            return
+        self.stats['received'] += 1
+        if self.policy == 'block':
+            await self.put((header, payload))
+            return
+        if self.queue.full():
+            if self.policy == 'drop_newest':
+                self.drop(header)
+                return
+            self.drop(self.queue.get_nowait()[0])
+        self.queue.put_nowait((header, payload))
+
+    async def run(self):
+        """Processes queued frames in order until None is queued or the client is gone
+        """
+        loop = asyncio.get_running_loop()
+        pool = self.service.pool
+        pending = deque()
+        closing = False
+        try:
+            while pending or not closing:
+                # Keep up to depth frames in the pool, finish the oldest when full or idle
+                if not closing and len(pending) < self.depth and (not pending or not self.queue.empty()):
+                    item = await self.queue.get()
+                    if item is None:
+                        closing = True
+                        continue
+                    header, payload = item
+                    if self.pipeline.scheduleDetection():
+                        job = loop.run_in_executor(pool, binaryJob, header, payload)
+                    else:
+                        job = None
+                    pending.append((header, payload, job))
+                    continue
+                await self.finish(*pending.popleft())
+        except ConnectionError:
+            pass
+        finally:
+            for _, _, job in pending:
+                if job is not None:
+                    job.cancel()
+
+    async def stop(self, graceful):
+        """Ends run(), after the queued frames when graceful, otherwise right away
+        """
+        if not graceful or not await self.put(None):
+            self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+
+    async def finish(self, header, payload, job):
+        result = {'op': 'result', 'seq': header.get('seq'), 'dropped': False}
+        overlay = b''
+        try:
+            if job is None and self.pipeline.detectionDue():
+                # Skipped when queued, but the tracking has moved on since
+                job = asyncio.get_running_loop().run_in_executor(self.service.pool, binaryJob, header, payload)
+            if job is None:
+                left_fit, right_fit = self.pipeline.coast()
+            else:
+                mask = bitmask.PackedMask(*await job)
+                # Tracking is serial per session but must not stall the other sessions
+                left_fit, right_fit = await asyncio.to_thread(self.pipeline.track, mask)
+            width, height = self.service.tables.warped_size
+            ym_per_pix, xm_per_pix = utils.laneScale((width, height))
+            off_center, left_curv, right_curv = utils.measureLane(left_fit, right_fit, height, ym_per_pix, xm_per_pix,
+                                                                  width/2)
+            result.update(left_fit = [float(v) for v in left_fit], right_fit = [float(v) for v in right_fit],
+                          off_center_m = float(off_center), left_curvature_m = float(left_curv),
+                          right_curvature_m = float(right_curv), predicted = job is None)
+            if header.get('overlay'):
+                overlay = await asyncio.get_running_loop().run_in_executor(
+                    self.service.pool, renderJob, header, payload, result['left_fit'], result['right_fit'])
+            self.stats['processed'] += 1
+        except Exception as e:
+            self.stats['failed'] += 1
+            result['error'] = '%s: %s' % (type(e).__name__, e)
+        self.reply(result, overlay)
+        if self.writer.is_closing():
+            raise ConnectionResetError('client is gone')
+        await self.writer.drain()
+
+
+class LaneService:
+    """asyncio lane detection server, one Session per connection, all sessions share one process pool
+
+    A client sends {"op": "open", ...session options}, then {"op": "frame", "seq": n, "encoding": "jpeg" or
+    "raw", "shape": [h, w, 3] for raw, "overlay": bool} messages with the frame as payload, and finally
+    {"op": "close"}. Every frame gets one {"op": "result"} reply with its seq: the fits, offset and curvatures,
+    or "error", in frame order; or "dropped": true as soon as the backpressure policy drops it. With
+    "overlay" the payload is the JPEG of the lane drawn on the frame.
+    """
+    def __init__(self, pattern = calibration.CALIBRATION_GLOB, processes = None, roi_scale = None, metrics = None):
+        self.cal = calibration.getCalibration(pattern)
+        self.tables = remap.getRemapTables(self.cal)
+        self.roi = remap.laneRoi(self.cal.img_size, roi_scale) if roi_scale else None
+        if self.roi is not None:
+            remap.getRemapTables(self.cal, roi = self.roi)
+        self.metrics = metrics if metrics is not None else lanemetrics.NullMetrics()
+        # Calibrated and cached above, so workers only load the artifacts
+        self.pool = ProcessPoolExecutor(processes, initializer = initWorker, initargs = (pattern, self.roi))
+        self.ids = itertools.count(1)
+        self.sessions = {}
+
+    async def handle(self, reader, writer):
+        session = None
+        # Queued frames are only finished for a client that closes its session or gets an error reply, a
+        # dropped connection cancels them
+        graceful = False
+        try:
+            header, payload = await readMessage(reader)
+            if header is None or header.get('op') != 'open':
+                writer.write(packMessage({'op': 'error', 'error': 'expected open'}))
+                return
+            options = {k: header[k] for k in ('track_every', 'policy', 'queue_size', 'depth') if k in header}
+            session = Session(self, next(self.ids), writer, **options)
+            self.sessions[session.sid] = session
+            session.start()
+            session.reply({'op': 'opened'})
+            while True:
+                header, payload = await readMessage(reader)
+                if header is None:
+                    break
+                if header.get('op') == 'close':
+                    graceful = True
+                    break
+                if header.get('op') == 'frame':
+                    await session.push(header, payload)
+        except (ValueError, TypeError) as e:
+            writer.write(packMessage({'op': 'error', 'error': '%s: %s' % (type(e).__name__, e)}))
+            graceful = True
+        except ConnectionError:
+            pass
+        finally:
+            try:
+                if session is not None:
+                    await session.stop(graceful)
+                    if graceful:
+                        session.reply({'op': 'closed', 'stats': session.stats})
+                await writer.drain()
+            except ConnectionError:
+                pass
+            finally:
+                if session is not None:
+                    self.sessions.pop(session.sid, None)
+                writer.close()
+                try:
+                    await writer.wait_closed()
+                except ConnectionError:
+                    pass
+
+    async def serve(self, path = None, host = '127.0.0.1', port = 8765):
+        # Fork the workers before the first connection, forked later they inherit and hold open its socket
+        await asyncio.get_running_loop().run_in_executor(self.pool, int)
+        if path is not None:
+            server = await asyncio.start_unix_server(self.handle, path)
+        else:
+            server = await asyncio.start_server(self.handle, host, port)
+        async with server:
+            await server.serve_forever()
+
+    def close(self):
+        self.pool.shutdown(cancel_futures = True)
+        self.metrics.write()
+
+
+class LaneClient:
+    """Client of one LaneService stream, see LaneService for the protocol
+    """
+    async def connect(self, path = None, host = '127.0.0.1', port = 8765, **options):
+        if path is not None:
+            self.reader, self.writer = await asyncio.open_unix_connection(path)
+        else:
+            self.reader, self.writer = await asyncio.open_connection(host, port)
+        self.seq = 0
+        self.writer.write(packMessage(dict(options, op = 'open')))
+        header, _ = await readMessage(self.reader)
+        if header is None or header.get('op') != 'opened':
+            raise ConnectionError('cannot open session: %s' % (header or {}).get('error'))
+        self.session = header['session']
+        return self
+
+    async def send(self, frame, overlay = False):
+        """Queues one frame, encoded image bytes or an RGB array, and returns its sequence number
+        """
+        header = {'op': 'frame', 'seq': self.seq, 'overlay': overlay}
+        if isinstance(frame, np.ndarray):
+            header.update(encoding = 'raw', shape = list(frame.shape))
+            frame = np.ascontiguousarray(frame, np.uint8).tobytes()
+        self.writer.write(packMessage(header, frame))
+        await self.writer.drain()
+        self.seq += 1
+        return header['seq']
+
+    async def receive(self):
+        """Returns the next (header, payload) reply, the header of the final one has op "closed"
+        """
+        return await readMessage(self.reader)
+
+    async def close(self):
+        self.writer.write(packMessage({'op': 'close'}))
+        await self.writer.drain()
+
+
+async def replayStream(images, address, repeat = 1, overlay = False, **options):
+    """Streams the encoded images repeat times through one session, returns its results and closing stats
+    """
+    client = await LaneClient().connect(**address, **options)
+    results = []
+    stats = {}
+
+    async def receiver():
+        while True:
+            header, payload = await client.receive()
+            if header is None or header['op'] == 'closed':
+                stats.update((header or {}).get('stats', {}))
+                return
+            if header['op'] == 'result':
+                results.append(header)
+
+    task = asyncio.create_task(receiver())
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for img in images:
+            await client.send(img, overlay)
+    await client.close()
+    await task
+    stats['seconds'] = time.perf_counter() - start
+    return results, stats
+
+
+async def replayImages(fpaths, address, streams = 4, repeat = 1, overlay = False, **options):
+    """Replays the image files as concurrent streams, e.g. test_images, returns [(results, stats)] per stream
+    """
+    images = []
+    for fpath in fpaths:
+        with open(fpath, 'rb') as f:
+            images.append(f.read())
+    return await asyncio.gather(*[replayStream(images, address, repeat, overlay, **options) for _ in range(streams)])
+
+
+def main(argv = None, prog = None):
+    import glob
+
+    parser = argparse.ArgumentParser(prog = prog, description = 'Serve lane detection to many streams, or replay images against a server')
+    parser.add_argument('--unix', help = 'unix socket path, TCP on --host/--port otherwise')
+    parser.add_argument('--host', default = '127.0.0.1')
+    parser.add_argument('--port', type = int, default = 8765)
+    parser.add_argument('--processes', type = int, default = None, help = 'shared worker processes, default cpu count')
+    parser.add_argument('--roi-scale', type = float, default = None, help = 'process a lane ROI at this scale')
+    parser.add_argument('--replay', help = 'act as client: glob of images to replay, e.g. "test_images/*.jpg"')
+    parser.add_argument('--streams', type = int, default = 4, help = 'concurrent replay streams')
+    parser.add_argument('--repeat', type = int, default = 10, help = 'times each stream replays the images')
+    parser.add_argument('--policy', default = 'drop_oldest', choices = POLICIES)
+    parser.add_argument('--track-every', type = int, default = None)
+    parser.add_argument('--metrics', metavar = 'PATH', help = 'server: write stage timings and counters to PATH, .prom for Prometheus')
+    args = parser.parse_args(argv)
+
+    address = {'path': args.unix} if args.unix else {'host': args.host, 'port': args.port}
+    if args.replay:
+        options = {'policy': args.policy}
+        if args.track_every is not None:
+            options['track_every'] = args.track_every
+        replies = asyncio.run(replayImages(sorted(glob.glob(args.replay)), address, args.streams, args.repeat, **options))
+        for i, (results, stats) in enumerate(replies):
+            print('stream %d: %d results, %s' % (i, len(results), json.dumps(stats, sort_keys = True)))
+    else:
+        metrics = lanemetrics.Metrics(args.metrics) if args.metrics else None
+        service = LaneService(processes = args.processes, roi_scale = args.roi_scale, metrics = metrics)
+        try:
+            asyncio.run(service.serve(**address))
+        finally:
+            service.close()
+
+
+if __name__ == '__main__':
+    main()
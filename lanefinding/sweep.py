@@ -0,0 +1,242 @@
+import argparse
+import glob
+import itertools
+import json
+import os
+import tempfile
+from multiprocessing import Pool
+
+import numpy as np
+import cv2
+
+from . import calibration
+from . import debug
+from . import metrics as lanemetrics
+from . import pipeline
+from . import pixelindex
+from . import remap
+from . import threshold
+
+THRESHOLD_PARAMS = ('v_thresh', 'b_thresh', 'hx_thresh')
+SEARCH_PARAMS = ('margin', 'nwindows', 'minpix', 'prev_margin')
+# The hard-coded settings of process_image and their neighbours
+GRID = {
+    'v_thresh': [(200, 255), (210, 255), (220, 255)],
+    'b_thresh': [(130, 255), (140, 255), (150, 255)],
+    'hx_thresh': [(20, 80), (30, 100)],
+    'margin': [40, 50, 70],
+    'nwindows': [7, 8, 9],
+    'minpix': [20, 50],
+    'prev_margin': [20, 30],
+}
+# Score of a frame without lanes, in pixels like the other error terms
+FAILURE_PENALTY = 100.0
+
+# Per worker process, set up once by initWorker
+_worker = {}
+
+
+def combinations(grid, names):
+    """Returns every combination of the grid values of names as a list of dicts
+    """
+    names = [name for name in names if name in grid]
+    return [dict(zip(names, values)) for values in itertools.product(*[grid[name] for name in names])]
+
+
+def computeFeatures(frames, lanePipeline, feature_dir):
+    """Stores what every threshold setting shares, per frame, as .npy files in feature_dir
+
+    The frames are equalized and warped once, and their l- and b-channels, |sobel x| of the s-channel and its
+    maximum are saved; the range tests of any threshold setting only need these.
+    """
+    engine = threshold.ThresholdEngine()
+    count = len(frames)
+    arrays = None
+    abs_max = np.zeros(count, np.int64)
+    for i, frame in enumerate(frames):
+        clahe = lanePipeline.equalizeWarp(frame)
+        l_channel, b_channel, s_channel = engine.channels(clahe)
+        abs_sobelx, abs_max[i] = engine.sobelAbs(s_channel)
+        if arrays is None:
+            shape = (count,) + l_channel.shape
+            arrays = {
+                'l': np.lib.format.open_memmap(os.path.join(feature_dir, 'l.npy'), 'w+', np.uint8, shape),
+                'b': np.lib.format.open_memmap(os.path.join(feature_dir, 'b.npy'), 'w+', np.uint8, shape),
+                'sobel': np.lib.format.open_memmap(os.path.join(feature_dir, 'sobel.npy'), 'w+', np.int16, shape),
+            }
+        arrays['l'][i] = l_channel
+        arrays['b'][i] = b_channel
+        arrays['sobel'][i] = abs_sobelx
+    for array in arrays.values():
+        array.flush()
+    np.save(os.path.join(feature_dir, 'abs_max.npy'), abs_max)
+
+
+def loadFeatures(feature_dir):
+    # Memory mapped, so all workers share one copy in the page cache
+    features = {name: np.load(os.path.join(feature_dir, name + '.npy'), mmap_mode = 'r') for name in ('l', 'b', 'sobel')}
+    features['abs_max'] = np.load(os.path.join(feature_dir, 'abs_max.npy'))
+    return features
+
+
+def initWorker(feature_dir, pattern, roi, sequence, reference):
+    cal = calibration.getCalibration(pattern)
+    _worker['cal'] = cal
+    _worker['tables'] = remap.getRemapTables(cal)
+    _worker['roi'] = roi
+    _worker['roi_tables'] = remap.getRemapTables(cal, roi = roi) if roi is not None else None
+    _worker['features'] = loadFeatures(feature_dir)
+    _worker['sequence'] = sequence
+    _worker['reference'] = reference
+
+
+def scoreRun(fits, lane_width, height, reference = None, sequence = True):
+    """Returns the metrics of one combination's per-frame fits (None where no lane was found), lower score is better
+
+    With reference fits the score is the mean x error at the bottom, middle and top of the bird's-eye view.
+    Without, it is the mean deviation of the lane width from lane_width plus, for a sequence, the mean
+    frame-to-frame jump of the lane bases.
+    """
+    y = np.array([height - 1, height/2, 0.0])
+    found = [i for i, fit in enumerate(fits) if fit is not None]
+    failures = len(fits) - len(found)
+    metrics = {'failures': failures}
+    if not found:
+        metrics['score'] = FAILURE_PENALTY
+        return metrics
+    x = np.array([[np.polyval(fits[i][0], y), np.polyval(fits[i][1], y)] for i in found])
+    if reference is not None:
+        ref = np.array([[np.polyval(reference[i][0], y), np.polyval(reference[i][1], y)] for i in found])
+        metrics['error_px'] = float(np.abs(x - ref).mean())
+        quality = metrics['error_px']
+    else:
+        width = x[:, 1] - x[:, 0]
+        metrics['width_error_px'] = float(np.abs(width - lane_width).mean())
+        quality = metrics['width_error_px']
+        if sequence and len(found) > 1:
+            metrics['jitter_px'] = float(np.abs(np.diff(x[:, :, 0], axis = 0)).mean())
+            quality += metrics['jitter_px']
+    metrics['score'] = (quality*len(found) + FAILURE_PENALTY*failures) / len(fits)
+    return metrics
+
+
+def sweepThresholds(thresholds, searches):
+    """Runs every search setting over all frames binarized with one threshold setting, returns their results
+    """
+    features = _worker['features']
+    sequence = _worker['sequence']
+    engine = threshold.ThresholdEngine(reuse_buffers = True, **thresholds)
+    # The counters tell a failed frame from one that kept the previous frame's fits
+    lanePipelines = [pipeline.LanePipeline(_worker['cal'], _worker['tables'], roi = _worker['roi'],
+                                           roi_tables = _worker['roi_tables'], metrics = lanemetrics.Metrics(), **search)
+                     for search in searches]
+    fits = [[] for _ in searches]
+    for i in range(len(features['abs_max'])):
+        sxbinary = engine.sobelRangeBinary(features['sobel'][i], int(features['abs_max'][i]))
+        binary, _, _ = engine.combine(features['l'][i], features['b'][i], sxbinary)
+        # One index per binary, shared by every search setting
+        index = pixelindex.RowPixelIndex.fromBinary(binary)
+        for lanePipeline, run in zip(lanePipelines, fits):
+            if not sequence:
+                lanePipeline.reset()
+            counters = lanePipeline.metrics.counters
+            dropped = counters.get('dropped_frames', 0)
+            try:
+                found = lanePipeline.track(binary, debug.NULL_FRAME, index)
+            except (TypeError, ValueError, np.linalg.LinAlgError):
+                found = None
+            run.append(found if counters.get('dropped_frames', 0) == dropped else None)
+
+    width, height = _worker['tables'].warped_size
+    lane_width = np.ptp(calibration.DST_POINTS[:, 0]) * width / 1280
+    results = []
+    for search, run in zip(searches, fits):
+        params = dict(thresholds, **search)
+        results.append(dict(params = params, **scoreRun(run, lane_width, height, _worker['reference'], sequence)))
+    return results
+
+
+def sweep(frames, grid = GRID, sequence = True, reference = None, pattern = calibration.CALIBRATION_GLOB, roi = None,
+          processes = None):
+    """Returns the results of every combination of grid over frames, best first
+
+    Parameters not in grid keep the LanePipeline defaults. The warp, CLAHE, color conversions and Sobel run
+    once per frame; a process pool then runs one threshold setting per task, and each task runs every search
+    setting on the same binaries. sequence tracks the frames as a clip, otherwise every frame is a still.
+    reference is an optional list of per-frame (left_fit, right_fit) in full bird's-eye pixels.
+    """
+    unknown = set(grid) - set(THRESHOLD_PARAMS) - set(SEARCH_PARAMS)
+    if unknown:
+        raise ValueError('unknown sweep parameters: %s' % ', '.join(sorted(unknown)))
+    cal = calibration.getCalibration(pattern)
+    lanePipeline = pipeline.LanePipeline(cal, roi = roi)
+    thresholds = combinations(grid, THRESHOLD_PARAMS)
+    searches = combinations(grid, SEARCH_PARAMS)
+
+    with tempfile.TemporaryDirectory(prefix = 'sweep-') as feature_dir:
+        computeFeatures(frames, lanePipeline, feature_dir)
+        with Pool(processes, initializer = initWorker, initargs = (feature_dir, pattern, roi, sequence, reference)) as pool:
+            results = [r for batch in pool.starmap(sweepThresholds, [(t, searches) for t in thresholds]) for r in batch]
+    results.sort(key = lambda r: r['score'])
+    return results
+
+
+def isVideo(source):
+    return os.path.isfile(source) and not source.lower().endswith(('.jpg', '.jpeg', '.png'))
+
+
+def readFrames(source):
+    """Returns the RGB frames of an image glob or a video file
+    """
+    if isVideo(source):
+        from . import video
+        return list(video.readVideo(source))
+    fpaths = sorted(glob.glob(source))
+    if not fpaths:
+        raise IOError('no images match ' + source)
+    frames = []
+    for fpath in fpaths:
+        img = cv2.imread(fpath)
+        if img is None:
+            raise IOError('cannot read image ' + fpath)
+        frames.append(cv2.cvtColor(img, cv2.COLOR_BGR2RGB))
+    return frames
+
+
+def main(argv = None, prog = None):
+    parser = argparse.ArgumentParser(prog = prog, description = 'Rank threshold and lane search settings over a set of frames')
+    parser.add_argument('source', help = 'image glob, e.g. "test_images/*.jpg", or a video file')
+    parser.add_argument('--grid', help = 'JSON file of {parameter: [values]}, default the neighbourhood of the current settings')
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--stills', dest = 'sequence', action = 'store_false',
+                      help = 'score frames independently, the default for an image glob')
+    mode.add_argument('--sequence', dest = 'sequence', action = 'store_true',
+                      help = 'track the frames as a clip, the default for a video file')
+    parser.set_defaults(sequence = None)
+    parser.add_argument('--reference', help = 'JSON file of per-frame [left_fit, right_fit] to score against')
+    parser.add_argument('--processes', type = int, default = None)
+    parser.add_argument('--top', type = int, default = 10, help = 'number of results to print')
+    parser.add_argument('--output', help = 'write all ranked results to this JSON file')
+    args = parser.parse_args(argv)
+
+    grid = GRID
+    if args.grid:
+        with open(args.grid) as f:
+            # JSON has no tuples, ranges come back as lists
+            grid = {name: [tuple(v) if isinstance(v, list) else v for v in values] for name, values in json.load(f).items()}
+    reference = None
+    if args.reference:
+        with open(args.reference) as f:
+            reference = [(np.array(l), np.array(r)) for l, r in json.load(f)]
+
+    sequence = args.sequence if args.sequence is not None else isVideo(args.source)
+    results = sweep(readFrames(args.source), grid, sequence, reference, processes = args.processes)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent = 2)
+    for result in results[:args.top]:
+        print('%8.2f %s' % (result['score'], json.dumps(result['params'])))
+
+
+if __name__ == '__main__':
+    main()
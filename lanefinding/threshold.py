@@ -0,0 +1,122 @@
+import numpy as np
+import cv2
+
+from . import bitmask
+
+
+def rangeTable(thresh):
+    """Returns a 256 entry uint8 lookup table, 1 where thresh[0] <= value <= thresh[1]
+    """
+    table = np.zeros(256, np.uint8)
+    table[max(thresh[0], 0):max(min(thresh[1], 255) + 1, 0)] = 1
+    return table
+
+
+def sobelRange(abs_max, thresh):
+    # uint8(255*|sobel|/max) is within thresh exactly when |sobel| is within these integer bounds,
+    # so the scaled image never has to be built
+    low = -(-thresh[0]*abs_max // 255)
+    high = -(-(thresh[1] + 1)*abs_max // 255) - 1
+    return low, high
+
+
+class ThresholdEngine:
+    """Production version of utils.createThresholdBinary
+
+    Converts only the LUV l-, LAB b- and HLS s-channels, range tests them through precomputed lookup
+    tables and runs Sobel in int16. combined_binary is bit-identical to utils.createThresholdBinary.
+
+    With reuse_buffers the intermediates live in scratch arrays sized on the first frame, the returned
+    combined_binary is then only valid until the next call.
+    """
+    def __init__(self, v_thresh=(210, 255), b_thresh=(140, 255), hx_thresh=(20, 80), reuse_buffers = False):
+        self.v_thresh = v_thresh
+        self.b_thresh = b_thresh
+        self.hx_thresh = hx_thresh
+        self.l_table = rangeTable(v_thresh)
+        self.b_table = rangeTable(b_thresh)
+        self.reuse_buffers = reuse_buffers
+        self.buffers = {}
+
+    def buffer(self, name, shape, dtype = np.uint8):
+        # None lets OpenCV / NumPy allocate the output as usual
+        if not self.reuse_buffers:
+            return None
+        buf = self.buffers.get(name)
+        if buf is None or buf.shape != shape or buf.dtype != dtype:
+            buf = np.empty(shape, dtype)
+            self.buffers[name] = buf
+        return buf
+
+    def channels(self, img):
+        shape = img.shape[:2]
+        color = self.buffer('color', img.shape)
+        l_channel = cv2.extractChannel(cv2.cvtColor(img, cv2.COLOR_RGB2LUV, dst=color), 0, dst=self.buffer('l', shape))
+        b_channel = cv2.extractChannel(cv2.cvtColor(img, cv2.COLOR_RGB2LAB, dst=color), 2, dst=self.buffer('b', shape))
+        s_channel = cv2.extractChannel(cv2.cvtColor(img, cv2.COLOR_RGB2HLS, dst=color), 2, dst=self.buffer('s', shape))
+        return l_channel, b_channel, s_channel
+
+    def sobelAbs(self, s_channel):
+        """Returns (|sobel x|, its maximum), everything of the s-channel the gradient threshold depends on
+        """
+        # Sobel of an uint8 image fits in int16 exactly
+        sobelx = cv2.Sobel(s_channel, cv2.CV_16S, 1, 0, dst=self.buffer('sobel', s_channel.shape, np.int16))
+        abs_sobelx = np.abs(sobelx, out=sobelx)
+        return abs_sobelx, int(abs_sobelx.max())
+
+    def sobelBinary(self, s_channel):
+        return self.sobelRangeBinary(*self.sobelAbs(s_channel))
+
+    def sobelRangeBinary(self, abs_sobelx, abs_max):
+        sxbinary = self.buffer('sx', abs_sobelx.shape)
+        if abs_max == 0:
+            # Matches uint8(nan) == 0 of the float path
+            value = 1 if self.hx_thresh[0] <= 0 <= self.hx_thresh[1] else 0
+            return self.filled(sxbinary, abs_sobelx.shape, value)
+        low, high = sobelRange(abs_max, self.hx_thresh)
+        if low > high:
+            return self.filled(sxbinary, abs_sobelx.shape, 0)
+        sxbinary = cv2.inRange(abs_sobelx, low, high, dst=sxbinary)
+        return np.bitwise_and(sxbinary, 1, out=sxbinary)
+
+    def filled(self, buf, shape, value):
+        if buf is None:
+            return np.full(shape, value, np.uint8)
+        buf.fill(value)
+        return buf
+
+    def combine(self, l_channel, b_channel, sxbinary):
+        """Returns (combined_binary, l_binary, b_binary), the range tests of the channels or'ed with sxbinary
+        """
+        b_binary = cv2.LUT(b_channel, self.b_table, dst=self.buffer('b_binary', b_channel.shape))
+        l_binary = cv2.LUT(l_channel, self.l_table, dst=self.buffer('l_binary', l_channel.shape))
+
+        combined_binary = cv2.bitwise_or(l_binary, b_binary, dst=self.buffer('combined', l_channel.shape))
+        combined_binary = cv2.bitwise_or(combined_binary, sxbinary, dst=combined_binary)
+        return combined_binary, l_binary, b_binary
+
+    def apply(self, img, debug = False):
+        """Returns (combined_binary, color_binary), color_binary is None unless debug is set
+        """
+        l_channel, b_channel, s_channel = self.channels(img)
+        sxbinary = self.sobelBinary(s_channel)
+        combined_binary, l_binary, b_binary = self.combine(l_channel, b_channel, sxbinary)
+
+        color_binary = None
+        if debug:
+            color_binary = np.dstack((l_binary, b_binary, sxbinary)).astype(np.float64)
+        return combined_binary, color_binary
+
+    def applyPacked(self, img, debug = False):
+        """Returns (combined, channels) as bitmask.PackedMask, channels is (l, b, sx) when debug is set, else None
+
+        The packed masks own their bits, so they stay valid after the scratch buffers are reused and take
+        an eighth of the uint8 binaries, and 1/192 of the float64 color_binary, when kept.
+        """
+        l_channel, b_channel, s_channel = self.channels(img)
+        sxbinary = self.sobelBinary(s_channel)
+        combined_binary, l_binary, b_binary = self.combine(l_channel, b_channel, sxbinary)
+        channels = None
+        if debug:
+            channels = tuple(bitmask.PackedMask.fromBinary(binary) for binary in (l_binary, b_binary, sxbinary))
+        return bitmask.PackedMask.fromBinary(combined_binary), channels
@@ -0,0 +1,119 @@
+import numpy as np
+
+
+class LaneTracker:
+    """Kalman filter over both lanes' quadratic fits with a detection confidence and a detection schedule
+
+    The state of each lane is its fit x = A*t**2 + B*t + C with t = y/height, so all three coefficients are
+    in pixels and comparable. Between detections the state is held and its covariance grows by the process
+    noise; a detection is blended in with a measurement noise that grows as its confidence drops.
+
+    Confidence is scored per detection from the lane pixel counts and the lane width (its deviation from
+    lane_width and its change along the lane), and smoothed over frames. While it stays at or above high,
+    only every every'th frame is detected and the others are predicted; below low the caller should fall
+    back to a full search.
+    """
+    def __init__(self, size, lane_width, every = 3, high = 0.7, low = 0.3, min_pixels = 400, width_tolerance = 0.25,
+                 process_std = (4.0, 4.0, 2.0), measurement_std = (20.0, 15.0, 5.0), alpha = 0.5):
+        self.width, self.height = size
+        self.lane_width = lane_width
+        self.every = max(int(every), 1)
+        self.high = high
+        self.low = low
+        self.min_pixels = min_pixels
+        self.width_tolerance = width_tolerance
+        self.Q = np.diag(np.square(process_std))
+        self.R = np.diag(np.square(measurement_std))
+        self.alpha = alpha
+        # Pixel fit [a, b, c] -> normalized state [A, B, C]
+        self.to_state = np.array([self.height**2, self.height, 1.0])
+        self.reset()
+
+    def reset(self):
+        self.x = None
+        self.P = None
+        self.confidence = 0.0
+        self.skip = 0
+        # Frames the last detection lets skip, and frames predicted since
+        self.allowance = 0
+        self.coasted = 0
+
+    @property
+    def fits(self):
+        """Returns the (left_fit, right_fit) pixel fits of the current estimate
+        """
+        if self.x is None:
+            return None, None
+        left_fit, right_fit = self.x / self.to_state
+        return left_fit, right_fit
+
+    def collapsed(self):
+        return self.x is None or self.confidence < self.low
+
+    def schedule(self):
+        """Returns whether the next frame has to be detected, call once per frame in frame order
+        """
+        if self.skip > 0 and not self.collapsed():
+            self.skip -= 1
+            return False
+        return True
+
+    def overdue(self):
+        """Returns whether the next frame has to be detected even though schedule() let it skip earlier
+
+        Callers that schedule frames ahead of tracking them check this when they get to the frame: the
+        confidence may have dropped since, or the frames the last detection allows are used up.
+        """
+        return self.collapsed() or self.coasted >= self.allowance
+
+    def coast(self):
+        """Advances the estimate over a frame that is not detected
+        """
+        self.predict()
+        self.coasted += 1
+
+    def predict(self):
+        if self.P is not None:
+            self.P = self.P + self.Q
+
+    def score(self, left_fit, right_fit, counts):
+        """Returns the confidence in [0, 1] of one detection, counts are the lane pixel counts at full resolution
+        """
+        y = np.array([0.0, self.height/2, self.height - 1])
+        left_x = left_fit[0]*y**2 + left_fit[1]*y + left_fit[2]
+        right_x = right_fit[0]*y**2 + right_fit[1]*y + right_fit[2]
+        # Lanes swapped sides at the bottom of the view, the detection locked onto something else
+        if left_x[-1] > self.width/2 or right_x[-1] < self.width/2:
+            return 0.0
+        widths = right_x - left_x
+        tolerance = self.width_tolerance*self.lane_width
+        pixels = min(1.0, min(counts)/self.min_pixels)
+        width = max(0.0, 1 - abs(widths[-1] - self.lane_width)/tolerance)
+        parallel = max(0.0, 1 - (widths.max() - widths.min())/tolerance)
+        return pixels*width*parallel
+
+    def update(self, left_fit, right_fit, score):
+        """Blends a detection with the given score into the estimate and returns the new (left_fit, right_fit)
+        """
+        self.confidence = self.alpha*score + (1 - self.alpha)*self.confidence
+        z = np.stack((left_fit, right_fit)) * self.to_state
+        R = self.R / max(score, 1e-3)
+        if self.x is None:
+            self.x = z
+            self.P = np.stack((R, R))
+        else:
+            # Both lanes in one batched solve, K = P (P + R)^-1
+            S = self.P + R
+            K = np.linalg.solve(S, self.P).transpose(0, 2, 1)
+            self.x = self.x + np.einsum('nij,nj->ni', K, z - self.x)
+            self.P = self.P - K @ self.P
+        self.skip = self.allowance = self.every - 1 if self.confidence >= self.high else 0
+        self.coasted = 0
+        return self.fits
+
+    def miss(self):
+        """Records a frame whose detection failed or was rejected
+        """
+        self.confidence = (1 - self.alpha)*self.confidence
+        self.skip = self.allowance = 0
+        self.coasted = 0
@@ -1,12 +1,23 @@
 import numpy as np
 import cv2
-import matplotlib.pyplot as plt
-import matplotlib.image as mpimg
-import scipy.signal as signal
+from . import remap
+from . import threshold
+from . import pixelindex
+from . import debug
+from . import lanefit
 #matplotlib inline
 
+# Lean equivalent of createThresholdBinary used when no manual check is requested
+thresholdEngine = threshold.ThresholdEngine()
+
+def pyplot():
+    # matplotlib is only needed for manual checks, keep it out of headless workers
+    import matplotlib.pyplot as plt
+    return plt
+
 def calibrateCamera(fpath, nx, ny, manualCheck = False):
     # Read in a calibration image
+    import matplotlib.image as mpimg
     img = mpimg.imread(fpath)
 
     # Arrays to store object points and image points from all the images
@@ -36,6 +47,7 @@ def calibrateCamera(fpath, nx, ny, manualCheck = False):
     undistorted = cv2.undistort(img, mtx, dist)
 
     if manualCheck:
+        plt = pyplot()
         f, (ax1, ax2) = plt.subplots(1, 2, figsize=(24, 9))
         f.tight_layout()
         ax1.imshow(img)
@@ -69,6 +81,7 @@ def createThresholdBinary(img, v_thresh=(210, 255), b_thresh=(140, 255), hx_thre
     # lab = cv2.cvtColor(img, cv2.COLOR_BGR2LAB).astype(np.float)
     
     if manualCheck:
+        plt = pyplot()
         f, axarr = plt.subplots(4, 3, figsize=(10,10))
         axarr[0, 0].set_title('HSV h-channel')
         axarr[0, 0].imshow(get_image(hsv[:,:,0]))
@@ -129,7 +142,7 @@ def createThresholdBinary(img, v_thresh=(210, 255), b_thresh=(140, 255), hx_thre
     # Stack each channel
     # Note color_binary[:, :, 0] is all 0s, effectively an all black image. It might
     # be beneficial to replace this channel with something else.
-    color_binary = np.dstack(( l_binary, b_binary, sxbinary)).astype(np.float)
+    color_binary = np.dstack(( l_binary, b_binary, sxbinary)).astype(np.float64)
     
     # Combine the two binary thresholds
     combined_binary = np.zeros_like(sxbinary)
@@ -137,6 +150,7 @@ def createThresholdBinary(img, v_thresh=(210, 255), b_thresh=(140, 255), hx_thre
 
     # Plotting thresholded images
     if manualCheck:
+        plt = pyplot()
         f, (ax1, ax2, ax3) = plt.subplots(1, 3, figsize=(20,10))
         ax1.set_title('Stacked thresholds')
         ax1.imshow(color_binary)
@@ -148,6 +162,13 @@ def createThresholdBinary(img, v_thresh=(210, 255), b_thresh=(140, 255), hx_thre
 
     return combined_binary, color_binary
     
+def getThresholdBinary(img, manualCheck = False):
+    if manualCheck:
+        combined_binary, color_binary = createThresholdBinary(img, manualCheck = manualCheck)
+    else:
+        combined_binary, color_binary = thresholdEngine.apply(img)
+    return combined_binary
+    
 # def getUndistortedCroppedPerspectiveBinary(img, mtx, dist, M, manualCheck = False):
     # undistorted = cv2.undistort(img, mtx, dist)
     # combined_binary, color_binary = createThresholdBinary(undistorted, manualCheck = manualCheck)
@@ -174,9 +195,10 @@ def getPerspectiveBinary(undistorted, M, manualCheck = False):
     clahe = getCLAHE(undistorted)
     img_shape = (undistorted.shape[1], undistorted.shape[0])
     warpped = cv2.warpPerspective(clahe, M, img_shape, flags=cv2.INTER_LINEAR)
-    combined_binary, color_binary = createThresholdBinary(warpped, manualCheck = manualCheck)
+    combined_binary = getThresholdBinary(warpped, manualCheck = manualCheck)
     # warpped = cv2.warpPerspective(combined_binary, M, img_shape, flags=cv2.INTER_LINEAR)
     if manualCheck:
+        plt = pyplot()
         f, axarr = plt.subplots(2, 2, figsize=(20,10))
         axarr[0, 0].set_title('undistorted')
         axarr[0, 0].imshow(undistorted)
@@ -189,12 +211,30 @@ def getPerspectiveBinary(undistorted, M, manualCheck = False):
         plt.show()
     return combined_binary;
     
+def getWarpedBinary(img, tables, manualCheck = False):
+    # Equalize the camera frame like getPerspectiveBinary, then undistort and warp in a single remap
+    clahe = getCLAHE(img)
+    warpped = remap.warpFrame(clahe, tables)
+    combined_binary = getThresholdBinary(warpped, manualCheck = manualCheck)
+    if manualCheck:
+        plt = pyplot()
+        f, (ax1, ax2, ax3) = plt.subplots(1, 3, figsize=(20,10))
+        ax1.set_title('CLAHE')
+        ax1.imshow(clahe)
+        ax2.set_title('Warpped')
+        ax2.imshow(warpped)
+        ax3.set_title('binary')
+        ax3.imshow(combined_binary)
+        plt.show()
+    return combined_binary
     
-def getCLAHE(img):
+    
+def getCLAHE(img, clahe = None):
     ## Reference: https://stackoverflow.com/questions/24341114/simple-illumination-correction-in-images-opencv-c/24341809#24341809
     lab = cv2.cvtColor(img, cv2.COLOR_RGB2LAB)
-    # create a CLAHE object (Arguments are optional).
-    clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8,8))
+    # create a CLAHE object (Arguments are optional), callers processing many frames pass their own.
+    if clahe is None:
+        clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8,8))
     cl1 = clahe.apply(lab[:, :, 0])
     lab[:,:,0] = cl1
     res = cv2.cvtColor(lab, cv2.COLOR_LAB2RGB)
@@ -206,44 +246,100 @@ def window_mask(width, height, img_ref, center, level):
     output[int(img_ref.shape[0]-(level+1)*height):int(img_ref.shape[0]-level*height),max(0,int(center-width/2)):min(int(center+width/2),img_ref.shape[1])] = 1
     return output
     
-def find_window_centroids(warped, window_width, window_height, margin):
-    
-    window_centroids = [] # Store the (left,right) window centroid positions per level
-    window = np.ones(window_width) # Create our window template that we will use for convolutions
-    
-    # First find the two starting positions for the left and right lane by using np.sum to get the vertical image slice
-    # and then np.convolve the vertical image slice with the window template 
-    
-    # Sum quarter bottom of image to get slice, could use a different ratio
-    l_sum = np.sum(warped[int(3*warped.shape[0]/4):,:int(warped.shape[1]/2)], axis=0)
-    l_center = np.argmax(np.convolve(window,l_sum))-window_width/2
-    r_sum = np.sum(warped[int(3*warped.shape[0]/4):,int(warped.shape[1]/2):], axis=0)
-    r_center = np.argmax(np.convolve(window,r_sum))-window_width/2+int(warped.shape[1]/2)
-    
-    # Add what we found for the first layer
-    window_centroids.append((l_center,r_center))
-    
-    # Go through each layer looking for max pixel locations
-    for level in range(1,(int)(warped.shape[0]/window_height)):
-	    # convolve the window into the vertical slice of the image
-	    image_layer = np.sum(warped[int(warped.shape[0]-(level+1)*window_height):int(warped.shape[0]-level*window_height),:], axis=0)
-	    conv_signal = np.convolve(window, image_layer)
-	    # Find the best left centroid by using past left center as a reference
-	    # Use window_width/2 as offset because convolution signal reference is at right side of window, not center of window
-	    offset = window_width/2
-	    l_min_index = int(max(l_center+offset-margin,0))
-	    l_max_index = int(min(l_center+offset+margin,warped.shape[1]))
-	    l_center = np.argmax(conv_signal[l_min_index:l_max_index])+l_min_index-offset
-	    # Find the best right centroid by using past right center as a reference
-	    r_min_index = int(max(r_center+offset-margin,0))
-	    r_max_index = int(min(r_center+offset+margin,warped.shape[1]))
-	    r_center = np.argmax(conv_signal[r_min_index:r_max_index])+r_min_index-offset
-	    # Add what we found for that layer
-	    window_centroids.append((l_center,r_center))
-
-    return window_centroids
+def boxFilter(sums, width):
+    """Returns np.convolve(np.ones(width), sums) along the last axis, computed from a cumulative sum
+    """
+    length = sums.shape[-1]
+    cumulative = np.zeros(sums.shape[:-1] + (length + 1,), np.int64)
+    np.cumsum(sums, axis=-1, out=cumulative[..., 1:])
+    i = np.arange(length + width - 1)
+    return cumulative[..., np.minimum(i + 1, length)] - cumulative[..., np.maximum(i + 1 - width, 0)]
+    
+def columnSums(rows, axis):
+    # uint8 rows summed in uint16 vectorize much better than the default uint64, when they cannot overflow
+    if rows.dtype == np.uint8 and rows.shape[axis]*255 <= np.iinfo(np.uint16).max:
+        return rows.sum(axis=axis, dtype=np.uint16)
+    return rows.sum(axis=axis, dtype=np.int64)
+    
+def levelSums(warped, window_height, index = None):
+    """Returns the column sums of every window level of a (N, H, W) batch, shape (N, levels, W)
+    
+    Level l covers rows [H-(l+1)*window_height, H-l*window_height); level 0 is left zero since the
+    centroid search starts from the bottom quarter instead.
+    """
+    count, height, width = warped.shape
+    levels = (int)(height/window_height)
+    sums = np.zeros((count, max(levels, 1), width), np.int64)
+    if levels < 2:
+        return sums
+    if index is not None:
+        # Bin the row-sorted lit pixels by level instead of summing the image
+        row_level = np.full(height, levels, np.int64)
+        for level in range(1, levels):
+            row_level[int(height-(level+1)*window_height):int(height-level*window_height)] = level
+        keys = row_level[index.y]*width + index.x
+        sums[0] = np.bincount(keys, minlength=(levels+1)*width)[:levels*width].reshape(levels, width)
+        sums[0, 0] = 0
+        return sums
+    top = int(height-levels*window_height)
+    bottom = int(height-window_height)
+    if window_height == int(window_height):
+        # Equal height levels: one reshape and sum over all of them
+        rows = warped[:, top:bottom].reshape(count, levels-1, int(window_height), width)
+        sums[:, levels-1:0:-1] = columnSums(rows, 2)
+    else:
+        bounds = [int(height-(level+1)*window_height) for level in range(levels-1, 0, -1)] + [bottom]
+        sums[:, levels-1:0:-1] = np.add.reduceat(warped, bounds, axis=1, dtype=np.int64)[:, :-1]
+    return sums
+    
+def searchMax(signal, center, offset, margin, width):
+    # Per image argmax of signal within [center+offset-margin, center+offset+margin) clipped to [0, width)
+    result = np.empty(len(center))
+    for n in range(len(center)):
+        min_index = int(max(center[n]+offset-margin,0))
+        max_index = int(min(center[n]+offset+margin,width))
+        result[n] = np.argmax(signal[n, min_index:max_index])+min_index-offset
+    return result
+    
+def find_window_centroids(warped, window_width, window_height, margin, index = None):
+    """Returns the (left, right) window centroid per level, bottom level first
+    
+    warped may also be a (N, H, W) array or a list of binaries, the result is then one list per image.
+    index is an optional pixelindex.RowPixelIndex of a single 0/1 binary.
+    """
+    batch = isinstance(warped, (list, tuple)) or np.ndim(warped) == 3
+    warped = np.asarray(warped)
+    if not batch:
+        warped = warped[np.newaxis]
+    height, width = warped.shape[1:]
+    half = int(width/2)
+    
+    # First find the two starting positions for the left and right lane by summing the quarter bottom of image
+    # and convolving it with the window template, a box filter
+    if index is not None:
+        quarter_sum = index.columnHistogram(int(3*height/4), height)[np.newaxis]
+    else:
+        quarter_sum = columnSums(warped[:, int(3*height/4):, :], 1)
+    l_center = np.argmax(boxFilter(quarter_sum[:, :half], window_width), axis=-1)-window_width/2
+    r_center = np.argmax(boxFilter(quarter_sum[:, half:], window_width), axis=-1)-window_width/2+half
+    
+    # Window responses of every level at once, only the argmax chain below depends on the previous level
+    conv_signals = boxFilter(levelSums(warped, window_height, index), window_width)
+    # Use window_width/2 as offset because convolution signal reference is at right side of window, not center of window
+    offset = window_width/2
+    centroids = [(l_center, r_center)]
+    for level in range(1,(int)(height/window_height)):
+        conv_signal = conv_signals[:, level]
+        # Find the best left and right centroids by using past centers as a reference
+        l_center = searchMax(conv_signal, l_center, offset, margin, width)
+        r_center = searchMax(conv_signal, r_center, offset, margin, width)
+        centroids.append((l_center, r_center))
+    
+    window_centroids = [[(l[n], r[n]) for l, r in centroids] for n in range(warped.shape[0])]
+    return window_centroids if batch else window_centroids[0]
     
 def display_window(window_centroids, warped, window_width, window_height, margin):
+    plt = pyplot()
     # If we found any window centers
     if len(window_centroids) > 0:
 
@@ -278,23 +374,34 @@ def display_window(window_centroids, warped, window_width, window_height, margin
     plt.title('window fitting results')
     plt.show()
     
-def detectLanesWithoutPreFrame(binary_warped, margin = 50, nwindows = 7, minpix = 20, visualization = False):
-    print("detectLanesWithoutPreFrame is executed")
-    histogram = np.sum(binary_warped[int(binary_warped.shape[0]*3/4):,:], axis=0)
+def detectLanesWithoutPreFrame(binary_warped, margin = 50, nwindows = 7, minpix = 20, visualization = False, index = None,
+                               sink = debug.NULL_FRAME, fitter = lanefit.fitPair):
+    # sink is the debug.DebugRecorder handle of this frame, nothing is drawn unless it is active
+    # fitter turns both lanes' power sums into fits, a lanefit.LaneFitter also folds in past frames
+    sink.event('full_search')
+    draw = visualization or sink.active
+    # Row-sorted lit pixels of the 0/1 binary or bitmask.PackedMask, callers that already built one can pass
+    # it in and binary_warped = None
+    if index is None:
+        index = pixelindex.RowPixelIndex.fromBinary(binary_warped)
+    if draw and not isinstance(binary_warped, np.ndarray):
+        # None or a bitmask.PackedMask
+        binary_warped = index.toBinary()
+    histogram = index.columnHistogram(int(index.shape[0]*3/4), index.shape[0])
     # Create an output image to draw on and  visualize the result
-    out_img = np.dstack((binary_warped, binary_warped, binary_warped))*255
-    midpoint = np.int(histogram.shape[0]/2)
+    if draw:
+        out_img = np.dstack((binary_warped, binary_warped, binary_warped))*255
+    midpoint = int(histogram.shape[0]/2)
     leftx_base = np.argmax(histogram[:midpoint])
     rightx_base = np.argmax(histogram[midpoint:]) + midpoint
     
     # print((leftx_base, rightx_base))
     
     # Set height of windows
-    window_height = np.int(binary_warped.shape[0]/nwindows)
+    window_height = int(index.shape[0]/nwindows)
     # Identify the x and y positions of all nonzero pixels in the image
-    nonzero = binary_warped.nonzero()
-    nonzeroy = np.array(nonzero[0])
-    nonzerox = np.array(nonzero[1])
+    nonzeroy = index.y
+    nonzerox = index.x
     # Current positions to be updated for each window
     leftx_current = leftx_base
     rightx_current = rightx_base
@@ -303,27 +410,28 @@ def detectLanesWithoutPreFrame(binary_warped, margin = 50, nwindows = 7, minpix
     right_lane_inds = []
     for window in range(nwindows):
         # Identify window boundaries in x and y (and right and left)
-        win_y_low = binary_warped.shape[0] - (window+1)*window_height
-        win_y_high = binary_warped.shape[0] - window*window_height
+        win_y_low = index.shape[0] - (window+1)*window_height
+        win_y_high = index.shape[0] - window*window_height
         win_xleft_low = leftx_current - margin
         win_xleft_high = leftx_current + margin
         win_xright_low = rightx_current - margin
         win_xright_high = rightx_current + margin
         # Draw the windows on the visualization image
-        cv2.rectangle(out_img,(win_xleft_low,win_y_low),(win_xleft_high,win_y_high),(0,255,0), 2) 
-        cv2.rectangle(out_img,(win_xright_low,win_y_low),(win_xright_high,win_y_high),(0,255,0), 2) 
-        # Identify the nonzero pixels in x and y within the window
-        good_left_inds = ((nonzeroy >= win_y_low) & (nonzeroy < win_y_high) & (nonzerox >= win_xleft_low) & (nonzerox < win_xleft_high)).nonzero()[0]
-        good_right_inds = ((nonzeroy >= win_y_low) & (nonzeroy < win_y_high) & (nonzerox >= win_xright_low) & (nonzerox < win_xright_high)).nonzero()[0]
+        if draw:
+            cv2.rectangle(out_img,(win_xleft_low,win_y_low),(win_xleft_high,win_y_high),(0,255,0), 2) 
+            cv2.rectangle(out_img,(win_xright_low,win_y_low),(win_xright_high,win_y_high),(0,255,0), 2) 
+        # Identify the nonzero pixels in x and y within the window, only the window's rows are scanned
+        good_left_inds = index.window(win_y_low, win_y_high, win_xleft_low, win_xleft_high)
+        good_right_inds = index.window(win_y_low, win_y_high, win_xright_low, win_xright_high)
         # Append these indices to the lists
         left_lane_inds.append(good_left_inds)
         right_lane_inds.append(good_right_inds)
         # If you found > minpix pixels, recenter next window on their mean position
         if len(good_left_inds) > minpix:
-            leftx_current = np.int(np.mean(nonzerox[good_left_inds]))
+            leftx_current = int(np.mean(nonzerox[good_left_inds]))
             # leftx_current = (leftx_current - leftx_base)*2 + leftx_base
         if len(good_right_inds) > minpix:        
-            rightx_current = np.int(np.mean(nonzerox[good_right_inds]))
+            rightx_current = int(np.mean(nonzerox[good_right_inds]))
             # rightx_current = (rightx_current - rightx_base)*2 + rightx_base
             
         leftx_base = leftx_current
@@ -339,18 +447,21 @@ def detectLanesWithoutPreFrame(binary_warped, margin = 50, nwindows = 7, minpix
     rightx = nonzerox[right_lane_inds]
     righty = nonzeroy[right_lane_inds] 
 
-    # Fit a second order polynomial to each
-    left_fit = np.polyfit(lefty, leftx, 2)
-    right_fit = np.polyfit(righty, rightx, 2)
+    # Fit a second order polynomial to each, both solved together from their power sums
+    left_fit, right_fit = fitter(lanefit.powerSums(leftx, lefty), lanefit.powerSums(rightx, righty))
     
-    if visualization:
+    if draw:
         # Generate x and y values for plotting
-        ploty = np.linspace(0, binary_warped.shape[0]-1, binary_warped.shape[0] )
+        ploty = np.linspace(0, index.shape[0]-1, index.shape[0] )
         left_fitx = left_fit[0]*ploty**2 + left_fit[1]*ploty + left_fit[2]
         right_fitx = right_fit[0]*ploty**2 + right_fit[1]*ploty + right_fit[2]
 
         out_img[nonzeroy[left_lane_inds], nonzerox[left_lane_inds]] = [255, 0, 0]
         out_img[nonzeroy[right_lane_inds], nonzerox[right_lane_inds]] = [0, 0, 255]
+        if sink.active:
+            sink.image('windows', drawFits(np.copy(out_img), ploty, left_fitx, right_fitx))
+    if visualization:
+        plt = pyplot()
         plt.imshow(out_img)
         plt.plot(left_fitx, ploty, color='yellow')
         plt.plot(right_fitx, ploty, color='yellow')
@@ -360,16 +471,21 @@ def detectLanesWithoutPreFrame(binary_warped, margin = 50, nwindows = 7, minpix
 
     return left_fit, right_fit
     
-def detectLanesWithPreFram(binary_warped, margin, left_fit, right_fit, visualization = False):
+def detectLanesWithPreFram(binary_warped, margin, left_fit, right_fit, visualization = False, index = None,
+                           sink = debug.NULL_FRAME, fitter = lanefit.fitPair):
     # Assume you now have a new warped binary image 
     # from the next frame of video (also called "binary_warped")
     # It's now much easier to find line pixels!
-    nonzero = binary_warped.nonzero()
-    nonzeroy = np.array(nonzero[0])
-    nonzerox = np.array(nonzero[1])
-    # Search lanes based on previous frame ploy fit
-    left_lane_inds = ((nonzerox > (left_fit[0]*(nonzeroy**2) + left_fit[1]*nonzeroy + left_fit[2] - margin)) & (nonzerox < (left_fit[0]*(nonzeroy**2) + left_fit[1]*nonzeroy + left_fit[2] + margin))) 
-    right_lane_inds = ((nonzerox > (right_fit[0]*(nonzeroy**2) + right_fit[1]*nonzeroy + right_fit[2] - margin)) & (nonzerox < (right_fit[0]*(nonzeroy**2) + right_fit[1]*nonzeroy + right_fit[2] + margin)))  
+    if index is None:
+        index = pixelindex.RowPixelIndex.fromBinary(binary_warped)
+    if (visualization or sink.active) and not isinstance(binary_warped, np.ndarray):
+        binary_warped = index.toBinary()
+    nonzeroy = index.y
+    nonzerox = index.x
+    # Search lanes based on previous frame ploy fit, evaluated once per row instead of once per pixel
+    rows = np.arange(index.shape[0])
+    left_lane_inds = index.curveBand(left_fit[0]*(rows**2) + left_fit[1]*rows + left_fit[2], margin)
+    right_lane_inds = index.curveBand(right_fit[0]*(rows**2) + right_fit[1]*rows + right_fit[2], margin)
 
     # Again, extract left and right line pixel positions
     leftx = nonzerox[left_lane_inds]
@@ -377,15 +493,14 @@ def detectLanesWithPreFram(binary_warped, margin, left_fit, right_fit, visualiza
     rightx = nonzerox[right_lane_inds]
     righty = nonzeroy[right_lane_inds]
     # Fit a second order polynomial to each
-    left_fit_current = np.polyfit(lefty, leftx, 2)
-    right_fit_current = np.polyfit(righty, rightx, 2)
-    
-    # Generate x and y values for plotting
-    ploty = np.linspace(0, binary_warped.shape[0]-1, binary_warped.shape[0] )
-    left_fitx = left_fit_current[0]*ploty**2 + left_fit_current[1]*ploty + left_fit_current[2]
-    right_fitx = right_fit_current[0]*ploty**2 + right_fit_current[1]*ploty + right_fit_current[2]    
+    left_fit_current, right_fit_current = fitter(lanefit.powerSums(leftx, lefty), lanefit.powerSums(rightx, righty))
     
-    if visualization:
+    if visualization or sink.active:
+        # Generate x and y values for plotting
+        ploty = np.linspace(0, index.shape[0]-1, index.shape[0] )
+        left_fitx = left_fit_current[0]*ploty**2 + left_fit_current[1]*ploty + left_fit_current[2]
+        right_fitx = right_fit_current[0]*ploty**2 + right_fit_current[1]*ploty + right_fit_current[2]    
+        
         # Create an image to draw on and an image to show the selection window
         out_img = np.dstack((binary_warped, binary_warped, binary_warped))*255
         window_img = np.zeros_like(out_img)
@@ -406,6 +521,10 @@ def detectLanesWithPreFram(binary_warped, margin, left_fit, right_fit, visualiza
         cv2.fillPoly(window_img, np.int_([left_line_pts]), (0,255, 0))
         cv2.fillPoly(window_img, np.int_([right_line_pts]), (0,255, 0))
         result = cv2.addWeighted(out_img, 1, window_img, 0.3, 0)
+        if sink.active:
+            sink.image('band', drawFits(np.copy(result), ploty, left_fitx, right_fitx))
+    if visualization:
+        plt = pyplot()
         plt.imshow(result)
         plt.plot(left_fitx, ploty, color='yellow')
         plt.plot(right_fitx, ploty, color='yellow')
@@ -415,47 +534,94 @@ def detectLanesWithPreFram(binary_warped, margin, left_fit, right_fit, visualiza
     
     return left_fit_current, right_fit_current
     
+def drawFits(img, ploty, left_fitx, right_fitx):
+    # Yellow fitted curves, the cv2 counterpart of the plt.plot calls used for manual checks
+    for fitx in (left_fitx, right_fitx):
+        pts = np.int32(np.transpose(np.vstack([fitx, ploty])))
+        cv2.polylines(img, [pts], False, (255, 255, 0), 2)
+    return img
+    
 def calculateCurvature(left_fit, right_fit, y_eval = 700, ym_per_pix = 30/720):
     left_curv = ((1 + (2*left_fit[0]*y_eval*ym_per_pix + left_fit[1])**2)**1.5) / np.absolute(2*left_fit[0])
     right_curv = ((1 + (2*right_fit[0]*y_eval*ym_per_pix + right_fit[1])**2)**1.5) / np.absolute(2*right_fit[0])
     return left_curv, right_curv
     
 
-def drawDetectedBoundary(undistorted, inverseM, left_fit, right_fit, ym_per_pix = 30/720, xm_per_pix=3.7/700):
+def measureLane(left_fit, right_fit, height = 720, ym_per_pix = 30/720, xm_per_pix=3.7/700, midpoint = 640):
+    """Returns (distance from center, left curvature, right curvature) in meters
+    """
+    y_eval = height - 1
+    left_x = left_fit[0]*y_eval**2 + left_fit[1]*y_eval + left_fit[2]
+    right_x = right_fit[0]*y_eval**2 + right_fit[1]*y_eval + right_fit[2]
+    off_center = ((left_x + right_x)/2 - midpoint) * xm_per_pix
+    
+    # Polynomials in world space, rescaled in closed form instead of resampled and refitted
+    left_fit_cr = lanefit.worldFit(left_fit, ym_per_pix, xm_per_pix)
+    right_fit_cr = lanefit.worldFit(right_fit, ym_per_pix, xm_per_pix)
+    
+    left_curv, right_curv = calculateCurvature(left_fit_cr, right_fit_cr, y_eval)
+    return off_center, left_curv, right_curv
+    
+def laneScale(warped_size, ym_per_pix = 30/720, xm_per_pix=3.7/700):
+    """Returns (ym_per_pix, xm_per_pix) of a bird's-eye view of warped_size (width, height)
+
+    The defaults hold for the 1280x720 view, a scaled view covers the same road with other pixel counts.
+    """
+    width, height = warped_size
+    return ym_per_pix*720/height, xm_per_pix*1280/width
+
+def drawDetectedBoundary(undistorted, inverseM, left_fit, right_fit, ym_per_pix = 30/720, xm_per_pix=3.7/700, tables = None,
+                         out = None):
+    # With remap tables the input is the raw camera frame and the polygon is mapped through the lens model
+    # out is an optional preallocated buffer shaped like undistorted, or undistorted itself to draw in place
     ploty = np.linspace(0, undistorted.shape[0]-1, undistorted.shape[0] )
     left_fitx = left_fit[0]*ploty**2 + left_fit[1]*ploty + left_fit[2]
     right_fitx = right_fit[0]*ploty**2 + right_fit[1]*ploty + right_fit[2]
     
-    warpped_image = np.zeros_like(undistorted)
     left_fit_ps = np.array([np.transpose(np.vstack([left_fitx, ploty]))])    
     right_fit_ps = np.array([np.flipud(np.transpose(np.vstack([right_fitx, ploty])))])
     pts = np.hstack((left_fit_ps, right_fit_ps))
-    # fill area
-    cv2.fillPoly(warpped_image, np.int_([pts]), (0, 255, 0))
     
     # fill lines
     #cv2.polylines(warpped_image, np.int_([left_fit_ps]), False, (0, 255, 0))
     #cv2.polylines(warpped_image, np.int_([right_fit_ps]), False, (255, 0, 0))
-    # plt.imshow(warpped_image)
-    # plt.show()
-    
-    # Unwarp the filled area back to original perspective
-    unwarpped = cv2.warpPerspective(warpped_image, inverseM, (undistorted.shape[1], undistorted.shape[0])) 
     
-    # Combine the result with undistorted image
-    result = cv2.addWeighted(undistorted, 1, unwarpped, 0.3, 0)
+    # Map only the boundary of the area back to original perspective, not the whole warped frame
+    if tables is not None:
+        frame_pts = remap.warpedToFrame(pts[0], tables)
+    else:
+        height, width = undistorted.shape[:2]
+        clipped = np.clip(pts, 0, (width - 1, height - 1)).astype(np.float32)
+        frame_pts = cv2.perspectiveTransform(clipped, inverseM)[0]
+    frame_pts = np.int_(np.rint(frame_pts))
+    
+    # Combine the result with undistorted image, blending only the bounding box of the filled area
+    if out is None:
+        result = undistorted.copy()
+    else:
+        result = out
+        if out is not undistorted:
+            np.copyto(out, undistorted)
+    x, y, w, h = cv2.boundingRect(frame_pts)
+    x_stop = min(x + w, result.shape[1])
+    y_stop = min(y + h, result.shape[0])
+    x, y = max(x, 0), max(y, 0)
+    if x_stop > x and y_stop > y:
+        box = result[y:y_stop, x:x_stop]
+        overlay = np.zeros_like(box)
+        # fill area
+        cv2.fillPoly(overlay, [frame_pts - (x, y)], (0, 255, 0))
+        cv2.addWeighted(box, 1, overlay, 0.3, 0, dst = box)
     
     ## Put Text about off line distance and curvature
     font = cv2.FONT_HERSHEY_SIMPLEX
-    off_center = round(((left_fitx[-1] + right_fitx[-1])/2 - 640) * xm_per_pix * 100)
+    width, height = undistorted.shape[1::-1] if tables is None else tables.warped_size
+    ym_per_pix, xm_per_pix = laneScale((width, height), ym_per_pix, xm_per_pix)
+    off_center, left_curv, right_curv = measureLane(left_fit, right_fit, height, ym_per_pix, xm_per_pix, width/2)
+    off_center = round(off_center * 100)
     str1 = str('distance from center: ' + str(off_center) + 'cm')
     cv2.putText(result, str1 , (430,630), font, 1, (0,0,255), 2, cv2.LINE_AA)
     
-    # Fit new polynomials to x,y in world space
-    left_fit_cr = np.polyfit(ploty*ym_per_pix, left_fitx*xm_per_pix, 2)
-    right_fit_cr = np.polyfit(ploty*ym_per_pix, right_fitx*xm_per_pix, 2)
-    
-    left_curv, right_curv = calculateCurvature(left_fit_cr, right_fit_cr, np.max(ploty))
     curvature = round((left_curv + right_curv) * 0.5 / 1000, 2)
     str2 = str('radius of curvature: ' + str(curvature) + 'km')
     cv2.putText(result, str2, (430,670), font, 1, (0,0,255), 2, cv2.LINE_AA)    
@@ -486,7 +652,7 @@ def smooth(prev, curr, coeficient = 0.4):
     :param coeficient: smoothing coef.
     :return:
     '''
-    if prev == None:
+    if prev is None:
         return curr
     else:
         return curr*coeficient + prev*(1-coeficient)
\ No newline at end of file
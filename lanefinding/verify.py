@@ -0,0 +1,279 @@
+import argparse
+import glob
+
+import numpy as np
+import cv2
+
+from . import bitmask
+from . import calibration
+from . import fused
+from . import lanefit
+from . import pipeline
+from . import pixelindex
+from . import remap
+from . import threshold
+from . import utils
+
+# (v_thresh, b_thresh, hx_thresh): the defaults, then empty, full and single value ranges at the edges
+THRESHOLDS = [
+    ((210, 255), (140, 255), (20, 80)),
+    ((0, 255), (0, 0), (0, 0)),
+    ((255, 255), (255, 255), (255, 255)),
+    ((100, 50), (300, 400), (0, 255)),
+]
+# LanePipeline's search defaults, and the window template of the centroid search
+SEARCH = dict(margin = 50, nwindows = 8, minpix = 20, prev_margin = 20)
+CENTROIDS = dict(window_width = 50, window_height = 80, margin = 100)
+# Largest x difference between a power sums fit and np.polyfit over the bird's-eye rows, relative to the
+# largest |x| of the fit; the normal equations lose precision on pixels spanning few rows
+FIT_TOLERANCE = 1e-6
+
+
+def referenceBinary(img, v_thresh, b_thresh, hx_thresh):
+    # The float64 path the fast ones have to reproduce; its 0/0 scaling of a flat s-channel warns
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        combined_binary, _ = utils.createThresholdBinary(img, v_thresh, b_thresh, hx_thresh)
+    return combined_binary
+
+
+def compare(img, v_thresh, b_thresh, hx_thresh):
+    """Returns the names of the fast threshold paths whose pixels differ from utils.createThresholdBinary on img
+    """
+    reference = referenceBinary(img, v_thresh, b_thresh, hx_thresh)
+    engine = threshold.ThresholdEngine(v_thresh, b_thresh, hx_thresh)
+    mismatches = []
+    combined_binary, _ = engine.apply(img)
+    if not np.array_equal(combined_binary, reference):
+        mismatches.append('ThresholdEngine.apply')
+    mask, _ = engine.applyPacked(img)
+    if not np.array_equal(mask.toBinary(), reference):
+        mismatches.append('ThresholdEngine.applyPacked')
+
+    index = fused.FusedThreshold(engine)(img)
+    y, x = reference.nonzero()
+    if not (np.array_equal(index.y, y) and np.array_equal(index.x, x)):
+        mismatches.append('FusedThreshold')
+    elif index.histogram is not None:
+        y_low, y_high, counts = index.histogram
+        if not np.array_equal(counts, reference[y_low:y_high].sum(axis = 0)):
+            mismatches.append('FusedThreshold histogram')
+    return mismatches
+
+
+def referenceCentroids(warped, window_width, window_height, margin):
+    # find_window_centroids before its levels were vectorized, one np.convolve per level
+    window = np.ones(window_width)
+    l_sum = np.sum(warped[int(3*warped.shape[0]/4):, :int(warped.shape[1]/2)], axis=0)
+    l_center = np.argmax(np.convolve(window, l_sum)) - window_width/2
+    r_sum = np.sum(warped[int(3*warped.shape[0]/4):, int(warped.shape[1]/2):], axis=0)
+    r_center = np.argmax(np.convolve(window, r_sum)) - window_width/2 + int(warped.shape[1]/2)
+    window_centroids = [(l_center, r_center)]
+    offset = window_width/2
+    for level in range(1, int(warped.shape[0]/window_height)):
+        image_layer = np.sum(warped[int(warped.shape[0] - (level + 1)*window_height):int(warped.shape[0] - level*window_height), :], axis=0)
+        conv_signal = np.convolve(window, image_layer)
+        l_min_index = int(max(l_center + offset - margin, 0))
+        l_max_index = int(min(l_center + offset + margin, warped.shape[1]))
+        l_center = np.argmax(conv_signal[l_min_index:l_max_index]) + l_min_index - offset
+        r_min_index = int(max(r_center + offset - margin, 0))
+        r_max_index = int(min(r_center + offset + margin, warped.shape[1]))
+        r_center = np.argmax(conv_signal[r_min_index:r_max_index]) + r_min_index - offset
+        window_centroids.append((l_center, r_center))
+    return window_centroids
+
+
+def referenceWindows(binary_warped, margin, nwindows, minpix):
+    # detectLanesWithoutPreFrame before the row index and the power sums: a mask over every lit pixel per
+    # window and np.polyfit
+    histogram = np.sum(binary_warped[int(binary_warped.shape[0]*3/4):, :], axis=0)
+    midpoint = int(histogram.shape[0]/2)
+    leftx_current = np.argmax(histogram[:midpoint])
+    rightx_current = np.argmax(histogram[midpoint:]) + midpoint
+    window_height = int(binary_warped.shape[0]/nwindows)
+    nonzeroy, nonzerox = binary_warped.nonzero()
+    left_lane_inds = []
+    right_lane_inds = []
+    for window in range(nwindows):
+        win_y_low = binary_warped.shape[0] - (window + 1)*window_height
+        win_y_high = binary_warped.shape[0] - window*window_height
+        in_rows = (nonzeroy >= win_y_low) & (nonzeroy < win_y_high)
+        good_left_inds = (in_rows & (nonzerox >= leftx_current - margin) & (nonzerox < leftx_current + margin)).nonzero()[0]
+        good_right_inds = (in_rows & (nonzerox >= rightx_current - margin) & (nonzerox < rightx_current + margin)).nonzero()[0]
+        left_lane_inds.append(good_left_inds)
+        right_lane_inds.append(good_right_inds)
+        if len(good_left_inds) > minpix:
+            leftx_current = int(np.mean(nonzerox[good_left_inds]))
+        if len(good_right_inds) > minpix:
+            rightx_current = int(np.mean(nonzerox[good_right_inds]))
+    left_lane_inds = np.concatenate(left_lane_inds)
+    right_lane_inds = np.concatenate(right_lane_inds)
+    left_fit = np.polyfit(nonzeroy[left_lane_inds], nonzerox[left_lane_inds], 2)
+    right_fit = np.polyfit(nonzeroy[right_lane_inds], nonzerox[right_lane_inds], 2)
+    return left_fit, right_fit
+
+
+def referenceBand(binary_warped, margin, left_fit, right_fit):
+    # detectLanesWithPreFram before the per-row band search, the curves evaluated at every lit pixel
+    nonzeroy, nonzerox = binary_warped.nonzero()
+    fits = []
+    for fit in (left_fit, right_fit):
+        center = fit[0]*(nonzeroy**2) + fit[1]*nonzeroy + fit[2]
+        inds = (nonzerox > center - margin) & (nonzerox < center + margin)
+        fits.append(np.polyfit(nonzeroy[inds], nonzerox[inds], 2))
+    return fits[0], fits[1]
+
+
+def sameFits(fits, reference, height):
+    rows = np.arange(height)
+    for fit, ref in zip(fits, reference):
+        x = np.polyval(ref, rows)
+        if np.abs(np.polyval(fit, rows) - x).max() > FIT_TOLERANCE*max(np.abs(x).max(), 1.0):
+            return False
+    return True
+
+
+def attempt(fn, *args):
+    # (result, None), or (None, exception type) where the baseline and the fast path must both fail
+    try:
+        return fn(*args), None
+    except (TypeError, ValueError, np.linalg.LinAlgError) as e:
+        return None, type(e)
+
+
+def compareSearch(binary):
+    """Returns the names of the search paths whose result on a 0/1 binary differs from the baseline code
+    """
+    mismatches = []
+    height = binary.shape[0]
+    index = pixelindex.RowPixelIndex.fromBinary(binary)
+    y, x = binary.nonzero()
+    if not (np.array_equal(index.y, y) and np.array_equal(index.x, x)):
+        mismatches.append('RowPixelIndex')
+
+    if utils.find_window_centroids(binary, **CENTROIDS) != referenceCentroids(binary, **CENTROIDS):
+        mismatches.append('find_window_centroids')
+    if utils.find_window_centroids(binary, index = index, **CENTROIDS) != referenceCentroids(binary, **CENTROIDS):
+        mismatches.append('find_window_centroids(index)')
+
+    margin, nwindows, minpix = SEARCH['margin'], SEARCH['nwindows'], SEARCH['minpix']
+    fits, error = attempt(utils.detectLanesWithoutPreFrame, None, margin, nwindows, minpix, False, index)
+    reference, reference_error = attempt(referenceWindows, binary, margin, nwindows, minpix)
+    if error != reference_error or (fits is not None and not sameFits(fits, reference, height)):
+        mismatches.append('detectLanesWithoutPreFrame')
+    if reference is None:
+        return mismatches
+
+    # Band search around the baseline fits, and around a straight pair whose band leaves the image
+    for previous in (reference, (np.array([0.0, 0.0, 40.0]), np.array([0.0, 0.5, binary.shape[1] - 40.0]))):
+        fits, error = attempt(utils.detectLanesWithPreFram, None, SEARCH['prev_margin'], previous[0], previous[1],
+                              False, index)
+        reference_band, reference_error = attempt(referenceBand, binary, SEARCH['prev_margin'], *previous)
+        if error != reference_error or (fits is not None and not sameFits(fits, reference_band, height)):
+            mismatches.append('detectLanesWithPreFram')
+    return mismatches
+
+
+def compareMask(binary):
+    """Returns the names of the bitmask.PackedMask operations that differ from the same ones on the 0/1 binary
+    """
+    mask = bitmask.PackedMask.fromBinary(binary)
+    y, x = binary.nonzero()
+    height = binary.shape[0]
+    y_low, y_high = int(3*height/4), height
+    checks = {
+        'toBinary': np.array_equal(mask.toBinary(), binary),
+        'fromPixels': np.array_equal(bitmask.PackedMask.fromPixels(y, x, binary.shape).bits, mask.bits),
+        'nonzero': all(np.array_equal(a, b) for a, b in zip(mask.nonzero(), (y, x))),
+        'count': mask.count(y_low, y_high) == int(binary[y_low:y_high].sum()),
+        'columnHistogram': np.array_equal(mask.columnHistogram(y_low, y_high), binary[y_low:y_high].sum(axis = 0)),
+        'or': np.array_equal((mask | bitmask.PackedMask.fromBinary(binary[::-1])).toBinary(), binary | binary[::-1]),
+    }
+    return ['PackedMask.' + name for name, ok in checks.items() if not ok]
+
+
+def compareFitter(seed = 0, frames = 4, window = 3, decay = 0.8):
+    """Returns the names of the lanefit paths that differ from np.polyfit on random lane pixels
+
+    LaneFitter must match a weighted np.polyfit over the pixels of the last window frames, a frame k frames
+    old weighted by decay**k, which np.polyfit takes as sqrt(decay**k) on the residuals.
+    """
+    rng = np.random.default_rng(seed)
+    fitter = lanefit.LaneFitter(window, decay)
+    history = []
+    mismatches = []
+    for _ in range(frames):
+        lanes = []
+        for base in (300, 900):
+            y = rng.integers(0, 720, rng.integers(50, 500))
+            x = base + 1e-4*(y - 360.0)**2 + rng.normal(0, 5, len(y))
+            lanes.append((x, y))
+        fits = lanefit.fitPair(*[lanefit.powerSums(x, y) for x, y in lanes])
+        if not sameFits(fits, [np.polyfit(y, x, 2) for x, y in lanes], 720):
+            mismatches.append('fitPair')
+        history = (history + [lanes])[-window:]
+        fits = fitter(*[lanefit.powerSums(x, y) for x, y in lanes])
+        fitter.commit()
+        reference = []
+        for side in range(2):
+            age = [np.full(len(frame[side][1]), decay**k) for k, frame in enumerate(reversed(history))]
+            x = np.concatenate([frame[side][0] for frame in reversed(history)])
+            y = np.concatenate([frame[side][1] for frame in reversed(history)])
+            reference.append(np.polyfit(y, x, 2, w = np.sqrt(np.concatenate(age))))
+        if not sameFits(fits, reference, 720):
+            mismatches.append('LaneFitter')
+    return sorted(set(mismatches))
+
+
+def frames(pattern, cal, seed = 0):
+    """Yields (name, frame) of the stills as the threshold stage sees them, plus a flat and a random frame
+    """
+    lanePipeline = pipeline.LanePipeline(cal, remap.getRemapTables(cal))
+    for fname in sorted(glob.glob(pattern)):
+        img = cv2.cvtColor(cv2.imread(fname), cv2.COLOR_BGR2RGB)
+        yield fname, img
+        yield fname + ' (warped)', lanePipeline.equalizeWarp(img).copy()
+    yield 'flat', np.full((72, 128, 3), 127, np.uint8)
+    yield 'random', np.random.default_rng(seed).integers(0, 256, (72, 129, 3), np.uint8)
+
+
+def main(argv = None, prog = None):
+    parser = argparse.ArgumentParser(prog = prog, description = 'Check that ThresholdEngine and FusedThreshold '
+                                     'match utils.createThresholdBinary pixel for pixel, and the lane search '
+                                     'paths the baseline code')
+    parser.add_argument('source', nargs = '?', default = 'test_images/*.jpg', help = 'glob of test images')
+    parser.add_argument('--calibration', default = calibration.CALIBRATION_GLOB, help = 'chessboard image glob')
+    args = parser.parse_args(argv)
+
+    if fused.kernels() is None:
+        print('numba is not installed, FusedThreshold is checked through its fallback')
+    cal = calibration.getCalibration(args.calibration)
+    checked = failed = 0
+    for name, img in frames(args.source, cal):
+        for thresholds in THRESHOLDS:
+            mismatches = compare(img, *thresholds)
+            checked += 1
+            if mismatches:
+                failed += 1
+                print('%s %s: %s differ' % (name, thresholds, ', '.join(mismatches)))
+    print('%d frame and threshold combinations, %d mismatched' % (checked, failed))
+
+    # The search paths on the binaries of the default thresholds, plus a sparse random one of odd width
+    binaries = [(name, referenceBinary(img, *THRESHOLDS[0])) for name, img in frames(args.source, cal)]
+    binaries.append(('sparse', (np.random.default_rng(1).random((720, 1283)) < 0.01).astype(np.uint8)))
+    searched = mismatched = 0
+    for name, binary in binaries:
+        mismatches = compareSearch(binary) + compareMask(binary)
+        searched += 1
+        if mismatches:
+            mismatched += 1
+            print('%s: %s differ' % (name, ', '.join(mismatches)))
+    mismatches = compareFitter()
+    if mismatches:
+        mismatched += 1
+        print('random lane pixels: %s differ' % ', '.join(mismatches))
+    print('%d binaries and the fitters against the baseline search, %d mismatched' % (searched, mismatched))
+    return 1 if failed or mismatched else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
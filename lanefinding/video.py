@@ -0,0 +1,197 @@
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue
+
+import cv2
+
+# Marks the end of a frame queue
+_END = object()
+
+
+class StageWorkers:
+    """Thread pool for the stateless stages, each thread owns a clone of the pipeline for its scratch buffers
+    """
+    def __init__(self, lanePipeline, workers):
+        self.lanePipeline = lanePipeline
+        self.local = threading.local()
+        self.executor = ThreadPoolExecutor(workers)
+
+    def pipeline(self):
+        p = getattr(self.local, 'pipeline', None)
+        if p is None:
+            p = self.local.pipeline = self.lanePipeline.clone()
+        return p
+
+    def pixels(self, frame, sink):
+        # The pixel index owns its arrays, it can leave this thread as is
+        return self.pipeline().pixels(frame, sink)
+
+    def render(self, frame, left_fit, right_fit, sink):
+        # A new frame like LanePipeline.process, the caller's frames stay untouched
+        return self.pipeline().render(frame, left_fit, right_fit, sink = sink)
+
+    def submit(self, fn, *args):
+        return self.executor.submit(fn, *args)
+
+    def shutdown(self):
+        self.executor.shutdown(wait = True, cancel_futures = True)
+
+
+def readAhead(frames, depth):
+    """Iterates frames from a background thread, at most depth frames ahead of the consumer
+    """
+    queue = Queue(depth)
+    error = []
+    stop = threading.Event()
+
+    def reader():
+        try:
+            for frame in frames:
+                queue.put(frame)
+                if stop.is_set():
+                    break
+        except BaseException as e:
+            error.append(e)
+        finally:
+            queue.put(_END)
+
+    thread = threading.Thread(target = reader, daemon = True)
+    thread.start()
+    done = False
+    try:
+        while True:
+            frame = queue.get()
+            if frame is _END:
+                done = True
+                break
+            yield frame
+    finally:
+        # Unblock the reader if the consumer stopped early
+        stop.set()
+        while not done:
+            done = queue.get() is _END
+        thread.join()
+    if error:
+        raise error[0]
+
+
+def trackFrame(lanePipeline, frame, pixels, sink):
+    if pixels is None:
+        if not lanePipeline.detectionDue():
+            return lanePipeline.coast(sink)
+        # Skipped when read, but the tracking has moved on since; detect it here in the tracking thread
+        return lanePipeline.track(None, sink, lanePipeline.pixels(frame, sink), frame)
+    return lanePipeline.track(None, sink, pixels.result(), frame)
+
+
+def streamFrames(frames, lanePipeline, workers = None, depth = None):
+    """Yields lanePipeline.process(frame) for every RGB frame, in order, as new frames; frames is not modified
+
+    Decode, the per-frame stages (CLAHE, warp, threshold to lit pixels) and rendering overlap across a thread pool while
+    the lane tracking of lanePipeline runs serially in frame order. At most depth frames are in flight in
+    each stage, so a slow consumer throttles decoding. With a tracker the frames to detect are scheduled
+    when they are read, so skipping follows the confidence of the frames depth frames earlier; a skipped
+    frame is still detected when the confidence has collapsed, or too many frames in a row were skipped, by
+    the time it is tracked.
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if depth is None:
+        depth = 2*workers
+    stages = StageWorkers(lanePipeline, workers)
+    detections = deque()
+    renders = deque()
+    try:
+        for frame in readAhead(frames, depth):
+            sink = lanePipeline.nextFrame()
+            # Frames the tracker predicts skip the per-frame stages altogether
+            pixels = stages.submit(stages.pixels, frame, sink) if lanePipeline.scheduleDetection() else None
+            detections.append((frame, sink, pixels))
+            if len(detections) >= depth:
+                frame, sink, pixels = detections.popleft()
+                left_fit, right_fit = trackFrame(lanePipeline, frame, pixels, sink)
+                renders.append(stages.submit(stages.render, frame, left_fit, right_fit, sink))
+            if len(renders) >= depth:
+                yield renders.popleft().result()
+
+        while detections:
+            frame, sink, pixels = detections.popleft()
+            left_fit, right_fit = trackFrame(lanePipeline, frame, pixels, sink)
+            renders.append(stages.submit(stages.render, frame, left_fit, right_fit, sink))
+        while renders:
+            yield renders.popleft().result()
+    finally:
+        stages.shutdown()
+
+
+def readVideo(fpath):
+    """Yields the RGB frames of a video file
+    """
+    capture = cv2.VideoCapture(fpath)
+    if not capture.isOpened():
+        raise IOError('cannot open video ' + fpath)
+    try:
+        while True:
+            ret, frame = capture.read()
+            if not ret:
+                break
+            yield cv2.cvtColor(frame, cv2.COLOR_BGR2RGB, dst = frame)
+    finally:
+        capture.release()
+
+
+def processVideo(src_path, dst_path, lanePipeline, workers = None, depth = None, fourcc = 'mp4v'):
+    """Streams src_path through lanePipeline into dst_path, returns the number of frames written
+
+    Replaces VideoFileClip.fl_image(process_image).write_videofile, encoding runs on its own thread. The
+    metrics of lanePipeline are written once more at the end, however the run ends.
+    """
+    capture = cv2.VideoCapture(src_path)
+    fps = capture.get(cv2.CAP_PROP_FPS) or 25
+    capture.release()
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if depth is None:
+        depth = 2*workers
+
+    encoded = Queue(depth)
+    state = {'count': 0, 'error': None}
+
+    def writer():
+        out = None
+        try:
+            while True:
+                frame = encoded.get()
+                if frame is _END:
+                    break
+                if out is None:
+                    out = cv2.VideoWriter(dst_path, cv2.VideoWriter_fourcc(*fourcc), fps, (frame.shape[1], frame.shape[0]))
+                    if not out.isOpened():
+                        raise IOError('cannot open video writer ' + dst_path)
+                out.write(cv2.cvtColor(frame, cv2.COLOR_RGB2BGR, dst = frame))
+                state['count'] += 1
+        except BaseException as e:
+            state['error'] = e
+            # Keep draining so the producer never blocks on a dead writer
+            while encoded.get() is not _END:
+                pass
+        finally:
+            if out is not None:
+                out.release()
+
+    thread = threading.Thread(target = writer, daemon = True)
+    thread.start()
+    try:
+        for frame in streamFrames(readVideo(src_path), lanePipeline, workers, depth):
+            if state['error'] is not None:
+                break
+            encoded.put(frame)
+    finally:
+        encoded.put(_END)
+        thread.join()
+        lanePipeline.metrics.write()
+    if state['error'] is not None:
+        raise state['error']
+    return state['count']
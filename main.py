@@ -1,97 +1,79 @@
 import matplotlib.image as mpimg
 import matplotlib.pyplot as plt
-import utils
+from lanefinding import calibration, pipeline, remap, utils
 import cv2
-import numpy as np
-
-manualCheck = True
-
-# Step 1: Calibrate camera
-fpath = '.\camera_cal\calibration2.jpg'
-mtx, dist = utils.calibrateCamera(fpath, 9, 6, manualCheck = manualCheck)
-
-# Step 2: Calculate perspective matrix M.
-# Apply a distortion correction to raw images.
-straight_line_image = mpimg.imread('test_images/straight_lines1.jpg')
-# straight_line_image = mpimg.imread('test_images/challenge01.jpg')
-undistorted = cv2.undistort(straight_line_image, mtx, dist)
-
-### Manually measured 4 points (255, 683), (1052, 683), (594, 448), (684, 448)
-selected_points = np.float32([[260.041, 681.833],[1044.35, 681.833], [685.594, 450.61],[593.598, 450.61]])
-# Desired 4 points, make sure the center is 640
-points = np.float32([[390, 700],[890, 700],[890, 0], [390, 0]])
-
-img_shape = (straight_line_image.shape[1], straight_line_image.shape[0])
-M = cv2.getPerspectiveTransform(selected_points, points)
-inverseM = cv2.getPerspectiveTransform(points, selected_points)
-warpped = cv2.warpPerspective(undistorted, M, img_shape, flags=cv2.INTER_LINEAR)
-if manualCheck:
-    plt.imshow(warpped)
-    plt.show()
-
-# Use color transforms, gradients, etc., to create a thresholded binary image.
-# combined_binary, color_binary = utils.createThresholdBinary(undistorted, manualCheck = manualCheck)
-combined_binary, color_binary = utils.createThresholdBinary(warpped, manualCheck = manualCheck)
-
-
-# [important] define process image
-### Need parameters mtx, dist, M
-def process_image(img):
-    global left_fit
-    global right_fit
-
-    undistorted = cv2.undistort(img, mtx, dist)
-    warpped = utils.getPerspectiveBinary(undistorted, M, manualCheck = manualCheck)
-    margin = 50
-    if left_fit != None and right_fit != None:
-        left_fit_c, right_fit_c = utils.detectLanesWithPreFram(warpped, 20, left_fit, right_fit)
-        if utils.needRecalculateLeftAndRightLane(left_fit, right_fit):
-            left_fit_c, right_fit_c = utils.detectLanesWithoutPreFrame(warpped, margin, 8, visualization = manualCheck)
-    else:
-        left_fit_c, right_fit_c = utils.detectLanesWithoutPreFrame(warpped, margin, 8, visualization = manualCheck)
-        
-    left_fit = utils.smooth(left_fit, left_fit_c, coeficient = 1)
-    right_fit = utils.smooth(right_fit, right_fit_c, coeficient = 1)
-
-    # Warp the detected lane boundaries and draw back onto the original image.
-    return utils.drawDetectedBoundary(undistorted, inverseM, left_fit, right_fit)
-    
-    
-    
-# Step 3: Apply preprocess in a test image
-# Apply a perspective transform to undistorted binary image ("birds-eye view").
-test_image = mpimg.imread('test_images/straight_lines1.jpg')
-# test_image = mpimg.imread('test_images/challenge01.jpg')
-warpped = utils.getUndistortedPerspectiveBinary(test_image, mtx, dist, M, manualCheck=manualCheck)
-
-# Step 4: Detect lane pixels and fit to find the lane boundary
-margin = 50 # How much to slide left and right for searching
-#window_centroids = utils.find_window_centroids(warpped, window_width, window_height, margin)
-#utils.display_window(window_centroids, warpped, window_width, window_height, margin)
-left_fit, right_fit = utils.detectLanesWithoutPreFrame(warpped, margin, 7, visualization = manualCheck)
-
-# Step 5: Find curvature in next frame
-test_image = mpimg.imread('test_images/straight_lines2.jpg')
-warpped = utils.getUndistortedPerspectiveBinary(test_image, mtx, dist, M, manualCheck=manualCheck)
-utils.detectLanesWithPreFram(warpped, margin, left_fit, right_fit, visualization = manualCheck)
-
-# Step 6: Warp the detected lane boundaries back onto the original image.
-utils.drawDetectedBoundary(test_image, inverseM, left_fit, right_fit)
-
-
-manualCheck = False
-
-# # Step 7: Generate video
-# from moviepy.editor import VideoFileClip
-
-# left_fit = None
-# right_fit = None
-# # white_output = 'challenge_video_output.mp4'
-# white_output = 'project_video_output.mp4'
-# # To speed up the testing process you may want to try your pipeline on a shorter subclip of the video
-# #clip1 = VideoFileClip("test_videos/solidWhiteRight.mp4").subclip(0,2)
-# # clip1 = VideoFileClip("challenge_video.mp4")
-# clip1 = VideoFileClip("project_video.mp4")
-# white_clip = clip1.fl_image(process_image) #NOTE: this function expects color images!!
-# # %time white_clip.write_videofile(white_output, audio=False)
-# white_clip.write_videofile(white_output, audio=False)
+
+# calibration.getCalibration detects the chessboards in a process pool; with the spawn start method
+# (Windows, macOS) its workers re-import this script, so everything runs under the __main__ guard.
+if __name__ == '__main__':
+    manualCheck = True
+
+    # Step 1: Calibrate camera and calculate perspective matrix M.
+    # The result is cached on disk, keyed by a hash of camera_cal/*.jpg and the perspective points.
+    cal = calibration.getCalibration()
+    mtx, dist, M, inverseM = cal.mtx, cal.dist, cal.M, cal.inverseM
+    # Undistortion composed with M into one remap table, built once per calibration
+    tables = remap.getRemapTables(cal)
+
+    # Step 2: Apply a distortion correction to raw images.
+    straight_line_image = mpimg.imread('test_images/straight_lines1.jpg')
+    # straight_line_image = mpimg.imread('test_images/challenge01.jpg')
+    undistorted = cv2.undistort(straight_line_image, mtx, dist)
+
+    img_shape = (straight_line_image.shape[1], straight_line_image.shape[0])
+    warpped = cv2.warpPerspective(undistorted, M, img_shape, flags=cv2.INTER_LINEAR)
+    if manualCheck:
+        plt.imshow(warpped)
+        plt.show()
+
+    # Use color transforms, gradients, etc., to create a thresholded binary image.
+    # combined_binary, color_binary = utils.createThresholdBinary(undistorted, manualCheck = manualCheck)
+    combined_binary, color_binary = utils.createThresholdBinary(warpped, manualCheck = manualCheck)
+
+
+    # [important] define process image
+    ### LanePipeline holds mtx, dist, M, the tracking state and the per-frame scratch buffers
+    lanePipeline = pipeline.LanePipeline(cal, tables)
+    # To save the intermediate images of every 25th frame without blocking the pipeline:
+    # from lanefinding import debug
+    # lanePipeline = pipeline.LanePipeline(cal, tables, sink = debug.DebugRecorder('output_images/debug', every = 25))
+    # To threshold and search a half resolution grid around the lanes, 2-4x faster on large frames:
+    # lanePipeline = pipeline.LanePipeline(cal, tables, roi = remap.laneRoi(cal.img_size, scale = 0.5))
+    # To Kalman filter the fits and only detect every third frame while the tracking is confident:
+    # lanePipeline = pipeline.LanePipeline(cal, tables, track_every = 3)
+    process_image = lanePipeline.process
+
+
+    # Step 3: Apply preprocess in a test image
+    # Apply a perspective transform to undistorted binary image ("birds-eye view").
+    test_image = mpimg.imread('test_images/straight_lines1.jpg')
+    # test_image = mpimg.imread('test_images/challenge01.jpg')
+    warpped = utils.getUndistortedPerspectiveBinary(test_image, mtx, dist, M, manualCheck=manualCheck)
+
+    # Step 4: Detect lane pixels and fit to find the lane boundary
+    margin = 50 # How much to slide left and right for searching
+    #window_centroids = utils.find_window_centroids(warpped, window_width, window_height, margin)
+    #utils.display_window(window_centroids, warpped, window_width, window_height, margin)
+    left_fit, right_fit = utils.detectLanesWithoutPreFrame(warpped, margin, 7, visualization = manualCheck)
+
+    # Step 5: Find curvature in next frame
+    test_image = mpimg.imread('test_images/straight_lines2.jpg')
+    warpped = utils.getUndistortedPerspectiveBinary(test_image, mtx, dist, M, manualCheck=manualCheck)
+    utils.detectLanesWithPreFram(warpped, margin, left_fit, right_fit, visualization = manualCheck)
+
+    # Step 6: Warp the detected lane boundaries back onto the original image.
+    utils.drawDetectedBoundary(test_image, inverseM, left_fit, right_fit)
+
+
+    manualCheck = False
+
+    # # Step 7: Generate video
+    # # Decode, per-frame stages, serial lane tracking and encoding overlap on a thread pool
+    # # (or from a shell: python -m lanefinding video project_video.mp4 project_video_output.mp4)
+    # from lanefinding import video
+
+    # lanePipeline.reset()
+    # # white_output = 'challenge_video_output.mp4'
+    # white_output = 'project_video_output.mp4'
+    # # video.processVideo("challenge_video.mp4", white_output, lanePipeline)
+    # video.processVideo("project_video.mp4", white_output, lanePipeline)